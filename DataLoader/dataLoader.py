@@ -7,8 +7,9 @@ import os
 import random
 
 class MultiFileOptimizedChunkedDataset(Dataset):
-    def __init__(self, file_list_or_dir, sample_length):
+    def __init__(self, file_list_or_dir, sample_length, expand_pitches=True):
         self.sample_length = sample_length
+        self.expand_pitches = expand_pitches  # re-expand a compact (pitch band only) matrix1 to all 128 pitches
         self.file_list = self._get_file_list(file_list_or_dir)
         self.file_data = self._load_file_data()
     
@@ -31,6 +32,9 @@ class MultiFileOptimizedChunkedDataset(Dataset):
                     'path': file_path,
                     'total_samples': hf.attrs['total_samples'],
                     'chunk_size': hf.attrs['chunk_size'],
+                    'matrix1_packed': bool(hf.attrs.get('matrix1_packed', False)),
+                    'matrix1_width': int(hf.attrs['matrix1_shape'][1]) if 'matrix1_shape' in hf.attrs else 128,
+                    'matrix1_pitch_offset': int(hf.attrs.get('matrix1_pitch_offset', 0)),
                     'metadata': json.loads(hf.attrs['metadata'])
                 })
         return file_data
@@ -79,6 +83,17 @@ class MultiFileOptimizedChunkedDataset(Dataset):
                 matrix2_data = hf['matrix2'][start:end]
                 vector_data = hf['teaching_vector'][start:end]
 
+        # bit-packed bitmaps are unpacked only for the rows just read
+        if file_data['matrix1_packed']:
+            matrix1_data = np.unpackbits(matrix1_data, axis=1, count=file_data['matrix1_width'])
+
+        # a compact matrix1 holds only the band of pitches the piece uses; put it back in place among the 128
+        offset = file_data['matrix1_pitch_offset']
+        if self.expand_pitches and (offset != 0 or matrix1_data.shape[1] != 128):
+            expanded = np.zeros((len(matrix1_data), 128), dtype=matrix1_data.dtype)
+            expanded[:, offset:offset + matrix1_data.shape[1]] = matrix1_data
+            matrix1_data = expanded
+
         return {
             'matrix1': torch.FloatTensor(matrix1_data),
             'matrix2': torch.FloatTensor(matrix2_data),
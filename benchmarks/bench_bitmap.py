@@ -0,0 +1,70 @@
+# Benchmark for midi_to_bitmap (modules/midiscoretools.py)
+#
+# Times the vectorized bitmap (dense and sparse) against the original per-note, per-frame loop (kept here as reference_bitmap)
+# and checks that they are identical. --repeat tiles the piece end to end to simulate a long score.
+#
+# Usage (from anywhere): python benchmarks/bench_bitmap.py [-m MIDI] [-r FPS] [--repeat N]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from modules.midiscoretools import parse_midi, _read_midi_pitches_intervals, _pitches_intervals_to_bitmap, _pitches_intervals_to_sparse_bitmap
+
+
+def reference_bitmap(pitches, intervals, hop):
+    # the original midi_to_bitmap loop (dense int64, one assignment per note per frame)
+    frames = np.zeros((int(np.max(intervals)/hop) + 1, 128), dtype=int)
+    for pitch, interval in zip(pitches, intervals):
+        for i in range(int(interval[0] / hop), int(interval[1] / hop) + 1):
+            frames[i][pitch] = 1
+    return frames.swapaxes(1,0)
+
+
+def best_of(runs, f, *args):
+    best = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        result = f(*args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized midi_to_bitmap against the original loop")
+    parser.add_argument("-m", "--midi", default=os.path.join(ROOT, "scores/BartokRFD1/RefData/BartokRFD1.mid"), help="Input MIDI file")
+    parser.add_argument("-r", "--rate", type=float, default=86.133, help="FPS (default 86.133)")
+    parser.add_argument("--repeat", type=int, default=20, help="Tile the piece this many times end to end (default 20)")
+    parser.add_argument("--runs", type=int, default=3, help="Timing runs, best is reported (default 3)")
+    args = parser.parse_args()
+
+    hop = 1 / args.rate
+    pitches, intervals = _read_midi_pitches_intervals(parse_midi(args.midi))
+    length = np.max(intervals)
+    pitches = np.tile(pitches, args.repeat)
+    intervals = np.concatenate([intervals + k * length for k in range(args.repeat)])
+
+    t_new, new = best_of(args.runs, _pitches_intervals_to_bitmap, pitches, intervals, hop)
+    t_sparse, sparse_bitmap = best_of(args.runs, _pitches_intervals_to_sparse_bitmap, pitches, intervals, hop)
+    t_ref, ref = best_of(args.runs, reference_bitmap, pitches, intervals, hop)
+    sparse_bytes = sparse_bitmap.data.nbytes + sparse_bitmap.indices.nbytes + sparse_bitmap.indptr.nbytes
+
+    print(f"{len(pitches)} notes, {new.shape[1]} frames")
+    print(f"reference loop: {t_ref * 1000:9.1f} ms  {ref.nbytes / 1e6:8.1f} MB ({ref.dtype})")
+    print(f"vectorized:     {t_new * 1000:9.1f} ms  {new.nbytes / 1e6:8.1f} MB ({new.dtype})  {t_ref / t_new:.0f}x faster")
+
+    print(f"sparse:         {t_sparse * 1000:9.1f} ms  {sparse_bytes / 1e6:8.1f} MB (csr, {sparse_bitmap.nnz} cells on)")
+
+    identical = np.array_equal(ref, new) and np.array_equal(ref, sparse_bitmap.toarray())
+    print(f"identical: {identical}")
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
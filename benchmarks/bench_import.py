@@ -0,0 +1,56 @@
+# Import-time regression benchmark for modules/midiscoretools.py
+#
+# Every stage in programs/ imports midiscoretools at startup, and runAll.sh starts several stages per variant,
+# so the module must stay cheap to import: music21, scipy and librosa are only imported by the functions that use them.
+# This times a fresh interpreter importing the module (best of several runs) and fails if it is over budget
+# or if any of the heavy packages got imported along the way.
+#
+# Usage (from anywhere): python benchmarks/bench_import.py [--runs 5] [--budget-ms 500]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["music21", "scipy", "librosa"]
+
+# run in a child interpreter so nothing is already imported
+CHILD = f'''
+import sys, time, json
+sys.path.insert(0, {ROOT!r})
+t0 = time.perf_counter()
+import modules.midiscoretools
+t1 = time.perf_counter()
+print(json.dumps({{"seconds": t1 - t0, "heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+'''
+
+
+def time_import():
+    out = subprocess.run([sys.executable, "-c", CHILD], check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that importing modules.midiscoretools stays fast")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to time (default 5)")
+    parser.add_argument("--budget-ms", type=float, default=500, help="Allowed import time in ms, best of the runs (default 500)")
+    args = parser.parse_args()
+
+    results = [time_import() for _ in range(args.runs)]
+    best_ms = min(r["seconds"] for r in results) * 1000
+    heavy = sorted(set(m for r in results for m in r["heavy"]))
+
+    print(f"import modules.midiscoretools: best {best_ms:.1f} ms of {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    if heavy:
+        print(f"FAIL: heavy modules imported at module load: {', '.join(heavy)}")
+    if best_ms > args.budget_ms:
+        print("FAIL: import time over budget")
+
+    sys.exit(1 if heavy or best_ms > args.budget_ms else 0)
+
+
+if __name__ == "__main__":
+    main()
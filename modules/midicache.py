@@ -0,0 +1,126 @@
+# module midicache.py
+#
+# Opt-in on-disk cache for parsed midi files.
+# A parsed file is stored as a bundle: a directory of uncompressed .npy arrays (so they can be memory mapped on load)
+# plus an info.json, named by the SHA-1 of the midi file bytes and the parser version.
+# Turn it on by setting SCORETIMING_MIDI_CACHE to a directory (or calling configure()).
+# The cache is capped at SCORETIMING_MIDI_CACHE_MB megabytes (default 512); the least recently used bundles are evicted first.
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+CACHE_FORMAT_VERSION = 1
+
+_config = {"cache_dir": None, "max_mb": None}
+
+
+def configure(cache_dir, max_mb=None):
+    '''
+    configure(cache_dir, max_mb=None)
+        cache_dir - directory for the bundles (None turns the cache off, unless SCORETIMING_MIDI_CACHE is set)
+        max_mb - size cap in megabytes (None: SCORETIMING_MIDI_CACHE_MB, or 512)
+    '''
+    _config["cache_dir"] = cache_dir
+    _config["max_mb"] = max_mb
+
+
+def cache_dir():
+    '''
+    RETURNS: the cache directory, or None if the cache is off
+    '''
+    return _config["cache_dir"] or os.environ.get("SCORETIMING_MIDI_CACHE") or None
+
+
+def max_bytes():
+    max_mb = _config["max_mb"] if _config["max_mb"] is not None else float(os.environ.get("SCORETIMING_MIDI_CACHE_MB", 512))
+    return int(max_mb * 1024 * 1024)
+
+
+def file_key(midi_file, parser_version):
+    '''
+    RETURNS: the bundle name for a midi file - SHA-1 of its bytes, the parser version and the cache format version
+    '''
+    h = hashlib.sha1()
+    with open(midi_file, 'rb') as f:
+        h.update(f.read())
+    h.update(f"parser={parser_version};format={CACHE_FORMAT_VERSION}".encode())
+    return h.hexdigest()
+
+
+def load_bundle(key, directory=None):
+    '''
+    load_bundle(key, directory=None)
+    RETURNS: (arrays, info) for a cached bundle, with every array memory mapped read-only, or None on a miss
+    '''
+    directory = directory or cache_dir()
+    bundle = os.path.join(directory, key)
+    info_file = os.path.join(bundle, "info.json")
+    if not os.path.isfile(info_file):
+        return None
+
+    try:
+        with open(info_file, 'r') as f:
+            info = json.load(f)
+        arrays = {name: np.load(os.path.join(bundle, name + ".npy"), mmap_mode='r') for name in info["arrays"]}
+    except (OSError, ValueError, KeyError):
+        # a bundle that was evicted or damaged underneath us is just a miss
+        return None
+
+    # mark it as recently used for LRU eviction
+    os.utime(bundle)
+    return arrays, info
+
+
+def save_bundle(key, arrays, info, directory=None):
+    '''
+    save_bundle(key, arrays, info, directory=None)
+        arrays - dict of name: numpy array, each written as an uncompressed name.npy
+        info - json-able dict of everything else (the array names are added to it)
+    The bundle is written to a temporary directory and renamed into place, so readers never see a partial bundle.
+    Afterwards the cache is trimmed back under its size cap.
+    '''
+    directory = directory or cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    bundle = os.path.join(directory, key)
+
+    tmp = tempfile.mkdtemp(prefix=".tmp-", dir=directory)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + ".npy"), array)
+        with open(os.path.join(tmp, "info.json"), 'w') as f:
+            json.dump(dict(info, arrays=list(arrays.keys())), f, indent=4)
+        os.replace(tmp, bundle)
+    except OSError:
+        # another process got there first (or the cache is not writable); the cache is only an optimization
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    evict(directory)
+
+
+def _bundle_size(bundle):
+    return sum(entry.stat().st_size for entry in os.scandir(bundle) if entry.is_file())
+
+
+def evict(directory=None, limit=None):
+    '''
+    evict(directory=None, limit=None)
+    Removes least recently used bundles until the cache is no bigger than limit bytes (default max_bytes())
+    '''
+    directory = directory or cache_dir()
+    limit = max_bytes() if limit is None else limit
+
+    bundles = [entry for entry in os.scandir(directory) if entry.is_dir() and not entry.name.startswith(".tmp-")]
+    sizes = {entry.path: _bundle_size(entry.path) for entry in bundles}
+    total = sum(sizes.values())
+
+    for entry in sorted(bundles, key=lambda entry: entry.stat().st_mtime):
+        if total <= limit:
+            break
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= sizes[entry.path]
@@ -1,21 +1,25 @@
 # module midiscoretools.py
 
-from music21 import midi, meter, tempo, converter
 import os 
 import json
 from datetime import datetime
-from music21.midi import MidiFile, MetaEvents, getNumber, ChannelVoiceMessages
 
 from collections import namedtuple
 import bisect
+import weakref
 import struct
-from music21.midi.translate import getTimeForEvents
 
 import numpy as np
-from scipy import sparse
+
+from modules import smfreader, midicache
+from modules.smfreader import SMF
 
 import subprocess
 
+# music21 and scipy take seconds to import, so they are imported inside the functions that use them.
+# That keeps stages that only need Frame or the ParsedMidi tools (eg frameMatch) quick to start.
+# (benchmarks/bench_import.py checks this)
+
 
 def create_json_file_if_not_exists(file_name):
     # Ensure the directory exists
@@ -86,6 +90,9 @@ def addExtensionIfNeeded(fname, ext="npz") :
 
 
 def render_wav_with_fluidsynth(midi_file,  output_wav_file):
+    if isinstance(midi_file, ParsedMidi):
+        midi_file = midi_file.path
+
     command = [
         "fluidsynth",
         "-ni",              # No interactive mode
@@ -99,174 +106,400 @@ def render_wav_with_fluidsynth(midi_file,  output_wav_file):
 
     
 
-def loadBitmap(fname) :
+#################################################################################
+# Bitmap files
+# The default format is a compressed scipy sparse .npz.
+# The packed format is np.packbits rows (16 bytes per frame for 128 pitches) in an uncompressed .npy,
+# so it can be memory mapped and any window of frames unpacked without reading the rest of the file.
+#################################################################################
+class PackedBitmap:
+    '''
+    PackedBitmap(packed, width=128)
+        packed - uint8 array (frames, ceil(width/8)) of np.packbits rows, usually memory mapped by loadBitmap(fname, mmap=True)
+        width - number of columns (pitches) when unpacked
+    A lazy view of a bit-packed bitmap (time along rows): indexing or slicing it unpacks just those rows.
+        bm[1000:1256] -> uint8 array (256, width)
+    '''
+    def __init__(self, packed, width=128):
+        self.packed = packed
+        self.width = width
+
+    @property
+    def shape(self):
+        return (len(self.packed), self.width)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, key):
+        return np.unpackbits(self.packed[key], axis=-1, count=self.width)
+
+    def toarray(self):
+        return self[:]
+
+
+def bitmap_pitch_range(m):
+    '''
+    bitmap_pitch_range(m)
+        m - a bitmap (dense or scipy sparse), time along rows
+    RETURNS: (lowest, highest) column (pitch) with any note in it, or (0, -1) for an empty bitmap
+    '''
+    from scipy import sparse
+
+    cols = sparse.csr_matrix(m).indices if sparse.issparse(m) else np.flatnonzero(np.asarray(m).any(axis=0))
+    if len(cols) == 0:
+        return 0, -1
+    return int(cols.min()), int(cols.max())
+
+
+def loadBitmap(fname, as_sparse=False, mmap=False, compact=False) :
+    '''
+    loadBitmap(fname, as_sparse=False, mmap=False, compact=False)
+        as_sparse - if True, return the scipy sparse matrix as stored rather than a dense numpy array
+        mmap - if True, fname is a packed (.npy) bitmap, returned as a memory mapped PackedBitmap
+        compact - if True, return (bitmap, pitch_offset) with only the pitch band that was stored (see saveBitmap),
+            otherwise a compacted bitmap is re-expanded to all 128 pitches
+    A packed (.npy) bitmap loaded without mmap is unpacked to a dense array.
+    '''
+    if mmap or fname.lower().endswith('.npy'):
+        packed = np.load(addExtensionIfNeeded(fname, 'npy'), mmap_mode='r' if mmap else None)
+        bitmap = PackedBitmap(packed)
+        bitmap = bitmap if mmap else bitmap.toarray()
+        return (bitmap, 0) if compact else bitmap
+
+    from scipy import sparse
+
     # To load the sparse matrix:
     fname=addExtensionIfNeeded(fname, 'npz')
     loaded_sparse_matrix = sparse.load_npz(fname)
+    with np.load(fname) as loaded:
+        pitch_offset = int(loaded['pitch_offset']) if 'pitch_offset' in loaded.files else 0
+
+    if compact:
+        return (loaded_sparse_matrix if as_sparse else loaded_sparse_matrix.toarray()), pitch_offset
+
+    if pitch_offset != 0 or loaded_sparse_matrix.shape[1] != 128:
+        # shift the stored band back up to its pitches
+        csr = sparse.csr_matrix(loaded_sparse_matrix)
+        loaded_sparse_matrix = sparse.csr_matrix((csr.data, csr.indices + pitch_offset, csr.indptr), shape=(csr.shape[0], 128))
+    if as_sparse:
+        return loaded_sparse_matrix
 
     # Convert the sparse matrix back to a dense numpy array:
     return loaded_sparse_matrix.toarray()
 
-def saveBitmap(fname, m) :
+def saveBitmap(fname, m, packed=False, block_rows=65536, pitch_range=None) :
+    '''
+    saveBitmap(fname, m, packed=False, block_rows=65536, pitch_range=None)
+        m - a dense array or any scipy sparse matrix (sparse input is converted to csr without going through a dense array)
+        packed - if True, write the bit-packed, uncompressed .npy format (see PackedBitmap) instead of a sparse .npz.
+            Rows are packed block_rows at a time, so a sparse m is never made dense all at once.
+        pitch_range - (lowest, highest) pitch to keep, eg the min and max pitch from midi_to_bitmap, or bitmap_pitch_range(m).
+            Only that band of columns is stored in the .npz, with its lowest pitch as pitch_offset (loadBitmap puts it back).
+    '''
+    from scipy import sparse
+
+    if packed:
+        if pitch_range is not None:
+            raise ValueError("saveBitmap: a compact pitch range is stored in the .npz format only (the packed .npy has nowhere to keep the pitch offset)")
+        fname=addExtensionIfNeeded(fname, 'npy')
+        out = np.lib.format.open_memmap(fname, mode='w+', dtype=np.uint8, shape=(m.shape[0], (m.shape[1] + 7) // 8))
+        for start in range(0, m.shape[0], block_rows):
+            block = m[start:start + block_rows]
+            block = block.toarray() if sparse.issparse(block) else np.asarray(block)
+            out[start:start + len(block)] = np.packbits(block != 0, axis=1)
+        out.flush()
+        return
+
     sparse_matrix = sparse.csr_matrix(m)
     fname=addExtensionIfNeeded(fname, 'npz')
-    sparse.save_npz(fname , sparse_matrix, compressed=True)
+    if pitch_range is None:
+        sparse.save_npz(fname , sparse_matrix, compressed=True)
+        return
 
+    # the same arrays sparse.save_npz writes (so sparse.load_npz still reads it), plus the pitch offset
+    low, high = int(pitch_range[0]), int(pitch_range[1])
+    band = sparse_matrix[:, low:high + 1].tocsr()
+    np.savez_compressed(fname, format=b'csr', shape=band.shape, data=band.data, indices=band.indices, indptr=band.indptr,
+                        pitch_offset=low)
 
 #################################################################################
 # Used to convert midi file to a bit map
 #################################################################################
-TempoEntry = namedtuple("TempoEntry", ("start_ticks", "start_ms", "microsecondsPerTick"))
 
 def _read_midi_pitches_intervals(midi_file, **kwargs):
-    midi = MidiFile()
-    midi.open(midi_file)
-    midi.read()
+    notes = parse_midi(midi_file).notes
 
+    if "midi_tracks" in kwargs:
+        notes = notes[np.isin(notes["track"], list(kwargs["midi_tracks"]))]
 
-    # look for set_tempo in Track0
-    track0 = midi.tracks[0]
-    tempos = []
+    if len(notes) > 0:
+        return notes["pitch"].astype(int), np.column_stack((notes["start"], notes["end"]))
+    else:
+        return np.array([]), np.empty(shape=[0,2])
 
-    for t, ev in getTimeForEvents(track0):
-        if ev.type == MetaEvents.SET_TEMPO:
 
-            #print(f' ev.data is  {ev.data}')
-            #need to index a tuple in the notebook, but in the module getNumber is already an in
-            #print(f' mspq will be set to {getNumber(ev.data, 3)}[0]')
-            #print(f' mspq will be set to {getNumber(ev.data, 3)}')
-            mspq = getNumber(ev.data, 3)  # first data is number
-            #print(f' mspq is { mspq }')
+def _note_frame_spans(intervals, hop):
+    # first and last frame each note is sounding in - int() truncation of time/hop, as the bitmap has always used
+    return (intervals[:, 0] / hop).astype(np.int64), (intervals[:, 1] / hop).astype(np.int64)
 
 
+def _pitches_intervals_to_bitmap(pitches, intervals, hop):
+    nframes = int(np.max(intervals)/hop) + 1
+    first, last = _note_frame_spans(intervals, hop)
 
-            microsecondsPerTick = float(mspq) / midi.ticksPerQuarterNote
-            if len(tempos) == 0:
-                segment_start_ms = t * microsecondsPerTick
-            else:
-                segment_start_ms = tempos[-1].start_ms + (t - tempos[-1].start_ticks) * tempos[-1].microsecondsPerTick
-            tempos.append(TempoEntry(t, segment_start_ms, microsecondsPerTick))
+    frames = np.zeros((128, nframes), dtype=np.uint8)
+    # For each pitch, mark +1 on the first frame of every note and -1 just after its last frame;
+    # the running sum along time is then the number of notes sounding on that pitch in each frame.
+    for pitch in np.unique(pitches):
+        notes = pitches == pitch
+        counts = np.bincount(first[notes], minlength=nframes + 1) - np.bincount(last[notes] + 1, minlength=nframes + 1)
+        frames[pitch] = np.cumsum(counts[:nframes]) > 0
+    return frames
 
-    midi.close()
-    result = []
 
-    if "midi_tracks" in kwargs:
-        tracks = kwargs["midi_tracks"]
-    else:
-        tracks = range(len(midi.tracks))
-
-    for track_index in tracks:
-        #print(f'track_index = {track_index}')
-        track = midi.tracks[track_index]
-        raw_events = getTimeForEvents(track)
-        events = {}
-        for t, ev in raw_events:
-            tempo = tempos[bisect.bisect_right(tempos, t, key=lambda x: x.start_ticks) - 1]
-            seconds = (tempo.start_ms + (t - tempo.start_ticks) * tempo.microsecondsPerTick) / 1e6
-            if ev.type == ChannelVoiceMessages.NOTE_ON and ev.velocity > 0:
-                note_key = (ev.pitch, ev.channel)
-                if not note_key in events:
-                    events[note_key] = [(seconds, ev.velocity)]
-                else:
-                    events[note_key].append((seconds, ev.velocity))
-            elif ev.type == ChannelVoiceMessages.NOTE_OFF or (ev.type == ChannelVoiceMessages.NOTE_ON and ev.velocity == 0):
-                note_key = (ev.pitch, ev.channel)
-                if note_key in events:
-                    for time, velocity in events[note_key]:
-                        if seconds > time:
-                            result.append([time, seconds, ev.pitch])
-                    del events[note_key]
-    if len(result) > 0:
-        result = sorted(result, key=lambda x: x[0])
-        start, end, pitches = zip(*result)
-        return np.array(pitches), np.array(list(zip(start, end)))
-    else:
-        return np.array([]), np.empty(shape=[0,2])
+def midi_to_bitmap(file_name, fps = 86.1238):
+    '''
+    Converts a midi file (path or ParsedMidi) to a bitmap of 128 rows (midi pitches) by seconds*fps 
+        with a 0 or 1 (uint8) in the frame/note space if a midi note is on there.
+    '''
+    hop=1/fps
+    pitches, intervals = _read_midi_pitches_intervals(file_name)
+    frames = _pitches_intervals_to_bitmap(pitches, intervals, hop)
+    print(f"frames.shape is {frames.shape}")
+    return frames, min(pitches), max(pitches)
 
 
-def midi_to_bitmap(file_name, fps = 86.1238):
+def _pitches_intervals_to_sparse_bitmap(pitches, intervals, hop):
+    from scipy import sparse
+
+    nframes = int(np.max(intervals)/hop) + 1
+    first, last = _note_frame_spans(intervals, hop)
+
+    # one run of frame (column) indices per note, first..last inclusive, all laid end to end
+    lengths = last - first + 1
+    run_starts = np.cumsum(lengths) - lengths
+    cols = (np.arange(lengths.sum(), dtype=np.int64) - np.repeat(run_starts - first, lengths)).astype(np.int32)
+    rows = np.repeat(np.asarray(pitches, dtype=np.int32), lengths)
+
+    # overlapping notes on the same pitch add up when duplicates are summed, so set everything back to 1
+    bitmap = sparse.coo_matrix((np.ones(len(cols), dtype=np.uint8), (rows, cols)), shape=(128, nframes)).tocsr()
+    bitmap.data[:] = 1
+    return bitmap
+
+
+def midi_to_sparse_bitmap(file_name, fps = 86.1238):
     '''
-    Converts a midi file to a bitmap of 128 rows (midi pitches) by seconds*fps 
-        with a 0 or 1 in the frame/note space if a midi note is on there.
+    Same as midi_to_bitmap, but builds the bitmap directly as a scipy.sparse csr_matrix (128 rows by seconds*fps, uint8)
+        so memory is proportional to the number of note-on frames rather than to frames*128.
     '''
     hop=1/fps
-    ext = os.path.splitext(file_name)[1].lower()[1:]
     pitches, intervals = _read_midi_pitches_intervals(file_name)
-    # frames = np.zeros((int(np.max(intervals)/hop) + 1, max(pitches) + 1), dtype=int)
-    frames = np.zeros((int(np.max(intervals)/hop) + 1, 128), dtype=int)
-    print("frames.shape is {frames.shape}")
-    for pitch, interval in zip(pitches, intervals):
-        for i in range(int(interval[0] / hop), int(interval[1] / hop) + 1):
-            frames[i][pitch] = 1
-    return frames.swapaxes(1,0), min(pitches), max(pitches)
+    return _pitches_intervals_to_sparse_bitmap(pitches, intervals, hop), min(pitches), max(pitches)
+
+
+def midi_to_sparse_bitmaps(file_name, rates):
+    '''
+    midi_to_sparse_bitmaps(file_name, rates)
+        rates - a list of frame rates (fps)
+    Same as midi_to_sparse_bitmap at each of the frame rates, from one read of the notes.
+    RETURNS: dict of fps: (bitmap, min pitch, max pitch)
+    '''
+    pitches, intervals = _read_midi_pitches_intervals(file_name)
+    return {fps: (_pitches_intervals_to_sparse_bitmap(pitches, intervals, 1/fps), min(pitches), max(pitches)) for fps in rates}
 
 
 #################################################################################
-# 
+# Streaming bitmap
+# For pieces too long (or fps too high) for the whole roll to fit in memory, the bitmap is built
+# block_frames frames at a time from the notes sorted by start, and each block written out before the next is made.
+# Peak memory is one block plus the notes sounding across it, however long the piece is.
 #################################################################################
+def _pitches_intervals_to_bitmap_blocks(pitches, intervals, hop, block_frames=4096):
+    nframes = int(np.max(intervals)/hop) + 1
+    first, last = _note_frame_spans(intervals, hop)
+    pitches = np.asarray(pitches, dtype=np.int64)
 
-def count_total_ticks(midi_file):
+    order = np.argsort(first, kind="stable")
+    first, last, pitches = first[order], last[order], pitches[order]
+
+    active = np.empty(0, dtype=np.int64)  # indices of notes started before this block that may still be sounding
+    next_note = 0
+    for start in range(0, nframes, block_frames):
+        stop = min(start + block_frames, nframes)
+
+        # bring in the notes that start inside this block, and drop the ones that ended before it
+        new_next = np.searchsorted(first, stop, side='left')
+        active = np.concatenate((active, np.arange(next_note, new_next)))
+        next_note = new_next
+        active = active[last[active] >= start]
+
+        # same +1/-1 running sum as _pitches_intervals_to_bitmap, with each note clipped to the block
+        counts = np.zeros((128, stop - start + 1), dtype=np.int32)
+        np.add.at(counts, (pitches[active], np.maximum(first[active], start) - start), 1)
+        np.add.at(counts, (pitches[active], np.minimum(last[active], stop - 1) + 1 - start), -1)
+        yield start, (np.cumsum(counts[:, :-1], axis=1) > 0).astype(np.uint8)
+
+
+def midi_to_bitmap_blocks(file_name, fps = 86.1238, block_frames=4096):
     '''
-    Takes a midi_file file name
-    RETURNS the number of ticks in the longest track (so the total duration of the piece in ticks)
+    midi_to_bitmap_blocks(file_name, fps = 86.1238, block_frames=4096)
+    Generator version of midi_to_bitmap: yields (start_frame, block) where block is the uint8 (128, <=block_frames)
+        slice of the bitmap starting at start_frame. Stitched together the blocks are exactly midi_to_bitmap's frames.
     '''
-    # Create a MidiFile instance and open the file
-    mf = midi.MidiFile()
-    mf.open(midi_file)
-    
-    # Read the MIDI file into memory
-    mf.read()
-    
-    # Close the MIDI file as it's no longer needed
-    mf.close()
+    hop=1/fps
+    pitches, intervals = _read_midi_pitches_intervals(file_name)
+    yield from _pitches_intervals_to_bitmap_blocks(pitches, intervals, hop, block_frames)
 
-    # Initialize a variable to store the maximum tick count
-    total_ticks = 0
-    
-    # Iterate over all tracks to find the latest tick in each track
-    for track in mf.tracks:
-        current_ticks = 0
-        for event in track.events:
-            # Add the delta time of the current event to the running total
-            current_ticks += event.time
 
-        # After processing all events in the track, update the total_ticks
-        total_ticks = max(total_ticks, current_ticks)
+def stream_bitmap(file_name, fname, fps = 86.1238, block_frames=4096, packed=True, dataset='matrix1'):
+    '''
+    stream_bitmap(file_name, fname, fps = 86.1238, block_frames=4096, packed=True, dataset='matrix1')
+        Writes the bitmap of a midi file (path or ParsedMidi) block by block, time along rows, without ever holding all of it.
+        fname - a .h5/.hdf5 file: the bitmap is appended to a resizable dataset (bit-packed if packed, with the same
+                    matrix1_packed/matrix1_shape attrs as the HDF5 creator, which takes the file as its -m1), or
+                anything else: the packed .npy format of saveBitmap(..., packed=True) (memory mapped while it is written).
+                    That format is always bit-packed, so packed=False is only allowed with an .h5 file.
+    RETURNS: (nframes, min pitch, max pitch)
+    '''
+    h5 = fname.lower().endswith(('.h5', '.hdf5'))
+    if not packed and not h5:
+        raise ValueError(f"stream_bitmap writes {fname} as a bit-packed .npy; packed=False needs an .h5/.hdf5 file")
+
+    hop=1/fps
+    pitches, intervals = _read_midi_pitches_intervals(file_name)
+    nframes = int(np.max(intervals)/hop) + 1
+    blocks = _pitches_intervals_to_bitmap_blocks(pitches, intervals, hop, block_frames)
+
+    if h5:
+        import h5py
+        width = 16 if packed else 128
+        with h5py.File(fname, 'a') as hf:
+            if dataset in hf:
+                del hf[dataset]
+            out = hf.create_dataset(dataset, shape=(0, width), maxshape=(None, width), dtype=np.uint8,
+                                    chunks=(min(block_frames, nframes), width))
+            for start, block in blocks:
+                rows = np.packbits(block.T, axis=1) if packed else block.T
+                out.resize(start + len(rows), axis=0)
+                out[start:] = rows
+            hf.attrs[dataset + '_shape'] = (nframes, 128)
+            hf.attrs[dataset + '_packed'] = packed
+    else:
+        fname=addExtensionIfNeeded(fname, 'npy')
+        out = np.lib.format.open_memmap(fname, mode='w+', dtype=np.uint8, shape=(nframes, 16))
+        for start, block in blocks:
+            out[start:start + block.shape[1]] = np.packbits(block.T, axis=1)
+            out.flush()
+        del out
+
+    return nframes, min(pitches), max(pitches)
+
+
+#################################################################################
+# Multi-plane piano roll
+#################################################################################
+PIANOROLL_PLANES = ("onset", "sustain", "velocity")
+
+def _notes_to_pianoroll(notes, nframes, hop, planes):
+    roll = np.zeros((len(planes), 128, nframes), dtype=np.uint8)
+    if len(notes) == 0:
+        return roll
+
+    intervals = np.column_stack((notes["start"], notes["end"]))
+    first, last = _note_frame_spans(intervals, hop)
+    pitches = notes["pitch"].astype(np.intp)
+
+    # (pitch, frame) of every cell a note covers, one run per note, shared by the sustain and velocity planes
+    lengths = last - first + 1
+    run_starts = np.cumsum(lengths) - lengths
+    cols = np.arange(lengths.sum(), dtype=np.int64) - np.repeat(run_starts - first, lengths)
+    rows = np.repeat(pitches, lengths)
+
+    for i, plane in enumerate(planes):
+        if plane == "onset":
+            roll[i, pitches, first] = 1
+        elif plane == "sustain":
+            roll[i, rows, cols] = 1
+        elif plane == "velocity":
+            # the loudest note wins where notes on the same pitch overlap
+            np.maximum.at(roll[i], (rows, cols), np.repeat(notes["velocity"], lengths))
+        else:
+            raise ValueError(f"Unknown piano roll plane '{plane}' (known planes are {', '.join(PIANOROLL_PLANES)})")
+    return roll
+
+
+def midi_to_pianoroll(file_name, fps = 86.1238, planes = PIANOROLL_PLANES, stack_by = None):
+    '''
+    Converts a midi file (path or ParsedMidi) to several aligned uint8 planes of 128 rows (midi pitches) by seconds*fps, in one pass:
+        onset - 1 in the frame each note starts in
+        sustain - 1 wherever a note is on (the same as midi_to_bitmap)
+        velocity - the note-on velocity wherever a note is on
+    planes - which of the above to make, in order
+    stack_by - None, "channel" or "track": make the planes separately for every channel (or track) that has notes
+    RETURNS: (roll, names) - roll is a uint8 array (len(names), 128, frames) and names[i] says what roll[i] is,
+        eg "sustain", or "sustain_ch3" / "sustain_tr1" when stacked
+    '''
+    hop=1/fps
+    notes = parse_midi(file_name).notes
+    nframes = int(np.max(notes["end"])/hop) + 1
+
+    if stack_by is None:
+        return _notes_to_pianoroll(notes, nframes, hop, planes), list(planes)
+
+    if stack_by not in ("channel", "track"):
+        raise ValueError(f"stack_by must be None, 'channel' or 'track', not '{stack_by}'")
+    suffix = "ch" if stack_by == "channel" else "tr"
+
+    rolls, names = [], []
+    for group in np.unique(notes[stack_by]):
+        rolls.append(_notes_to_pianoroll(notes[notes[stack_by] == group], nframes, hop, planes))
+        names.extend(f"{plane}_{suffix}{group}" for plane in planes)
+    return np.concatenate(rolls), names
+
+
+def savePianoroll(fname, roll, names) :
+    '''
+    Saves each plane of a midi_to_pianoroll roll as its own array in an npz, with time along rows (like the saved bitmap)
+    '''
+    fname=addExtensionIfNeeded(fname, 'npz')
+    np.savez_compressed(fname, **{name: plane.T for name, plane in zip(names, roll)})
 
-    return total_ticks
+def loadPianoroll(fname) :
+    '''
+    RETURNS: dict of plane name: uint8 array (frames, 128) as written by savePianoroll
+    '''
+    fname=addExtensionIfNeeded(fname, 'npz')
+    with np.load(fname) as loaded:
+        return {name: loaded[name] for name in loaded.files}
+
+
+#################################################################################
+# 
+#################################################################################
+
+def count_total_ticks(midi_file):
+    '''
+    Takes a midi_file file name (or ParsedMidi)
+    RETURNS the number of ticks in the longest track (so the total duration of the piece in ticks)
+    '''
+    return parse_midi(midi_file).total_ticks
 
 
 
 def extract_time_signatures(midi_file):
     '''
-    Takes a midi file and returns a list of tuples consisting of 
+    Takes a midi file (or ParsedMidi) and returns a list of tuples consisting of 
     a tick number and a music21.meter.timeSignature:
     [(0, <music21.meter.TimeSignature 3/8>), ... (8880, <music21.meter.TimeSignature 6/8>)]
     '''
-    mf = MidiFile()
-    mf.open(midi_file)
-    mf.read()
+    from music21 import meter
 
-    time_signatures = []
-    accumulated_ticks = 0
-    
-    for track in mf.tracks:
-        accumulated_ticks = 0  # Reset for each track
-        for event in track.events:
-            if event.isDeltaTime:
-                accumulated_ticks += event.time  # Accumulate delta time
-            
-            # Check for a time signature event
-            if event.type == midi.MetaEvents.TIME_SIGNATURE:
-                numerator = event.data[0]
-                denominator = 2 ** event.data[1]  # The second byte is the denominator exponent
-                time_signature_event = meter.TimeSignature(f"{numerator}/{denominator}")
-                time_signatures.append((accumulated_ticks, time_signature_event))
-    
-    # Sort the time signatures by their tick position
-    time_signatures.sort(key=lambda x: x[0])
-    
-    return time_signatures
+    ts_map = parse_midi(midi_file).time_signatures
+
+    # skip the default 4/4 the map keeps in front of the file's own time signatures
+    return [(int(tick), meter.TimeSignature(f"{numerator}/{denominator}"))
+            for tick, numerator, denominator in zip(ts_map.ticks[1:], ts_map.numerators[1:], ts_map.denominators[1:])]
 
 
 
@@ -284,6 +517,8 @@ def ticks_per_beat_at_tick(tick_value, time_signatures, ticks_per_quarter_note):
         time_signatures - a datasctructure you can create with extract_time_signatures(mf) 
         ticks_per_quarter_note - ttte PPQ (note: not always equal to tpb - eg 6/8 has PPQ/2 tpb!)
     '''
+    from music21 import meter
+
     current_time_signature = meter.TimeSignature('4/4')  # Default to 4/4 if no signature is found
     
     # Find the most recent time signature before the given tick_value
@@ -319,6 +554,8 @@ def beats_per_measure_at_tick(tick_value, time_signatures) :
         time_signatures - a datasctructure you can create with extract_time_signatures(mf) 
     RETURNS: beats per measure, usually the numerator of the current time signature
     '''    
+    from music21 import meter
+
     current_time_signature = meter.TimeSignature('4/4')  # Default to 4/4 if no signature is found
     
     # Find the most recent time signature before the given tick_value
@@ -332,6 +569,77 @@ def beats_per_measure_at_tick(tick_value, time_signatures) :
 
 
 
+############################################################################
+# TimeSignatureMap
+# ticks_per_beat_at_tick and beats_per_measure_at_tick scan the list and build a music21 TimeSignature on every call.
+# A TimeSignatureMap keeps the time signature changes as plain int arrays and answers whole columns of ticks at once.
+############################################################################
+class TimeSignatureMap:
+    '''
+    TimeSignatureMap(ticks, numerators, denominators, ticks_per_quarter_note)
+        ticks - tick positions of the time signature changes (sorted)
+        numerators, denominators - the time signature set at each of those ticks
+        ticks_per_quarter_note - the PPQ of the midi file
+    Ticks before the first time signature are in 4/4 (as with ticks_per_beat_at_tick).
+    '''
+    def __init__(self, ticks, numerators, denominators, ticks_per_quarter_note):
+        self.ticks_per_quarter_note = ticks_per_quarter_note
+
+        # a 4/4 entry in front of everything stands in for "no time signature found yet"
+        self.ticks = np.concatenate(([np.iinfo(np.int64).min], np.asarray(ticks, dtype=np.int64)))
+        self.numerators = np.concatenate(([4], np.asarray(numerators, dtype=np.int64)))
+        self.denominators = np.concatenate(([4], np.asarray(denominators, dtype=np.int64)))
+
+        # quarter note gets the beat in x/4, eighth note in x/8, etc. (same rule as ticks_per_beat_at_tick)
+        self.ticks_per_beat = (4 * ticks_per_quarter_note) // self.denominators
+
+    @classmethod
+    def from_time_signatures(cls, time_signatures, ticks_per_quarter_note):
+        '''
+        Builds the map from the [(tick, music21.meter.TimeSignature), ...] list made by extract_time_signatures
+        '''
+        return cls([tick for tick, _ in time_signatures],
+                   [ts.numerator for _, ts in time_signatures],
+                   [ts.denominator for _, ts in time_signatures],
+                   ticks_per_quarter_note)
+
+    @classmethod
+    def from_midifile(cls, mf):
+        '''
+        Builds the map straight from the events of a music21 MidiFile that has already been read (no TimeSignature objects)
+        '''
+        from music21 import midi
+
+        changes = []
+        for track in mf.tracks:
+            accumulated_ticks = 0  # Reset for each track
+            for event in track.events:
+                if event.isDeltaTime:
+                    accumulated_ticks += event.time
+                if event.type == midi.MetaEvents.TIME_SIGNATURE:
+                    changes.append((accumulated_ticks, event.data[0], 2 ** event.data[1]))
+        changes.sort(key=lambda x: x[0])
+
+        return cls([c[0] for c in changes], [c[1] for c in changes], [c[2] for c in changes], mf.ticksPerQuarterNote)
+
+    def _index(self, ticks):
+        # the most recent time signature at or before each tick (the last one wins when several share a tick)
+        return np.searchsorted(self.ticks, ticks, side='right') - 1
+
+    def ticks_per_beat_at(self, ticks):
+        '''
+        RETURNS: ticks per beat at each of ticks (an array, or a single value)
+        '''
+        return self.ticks_per_beat[self._index(ticks)]
+
+    def beats_per_measure_at(self, ticks):
+        '''
+        RETURNS: beats per measure (the numerator of the time signature) at each of ticks (an array, or a single value)
+        '''
+        return self.numerators[self._index(ticks)]
+
+
+
 
 ############################################################################
 # time2tick
@@ -342,111 +650,299 @@ def getNumber(data, length):
     # Helper function to convert byte string to integer
     return struct.unpack('>I', b'\x00' * (4-length) + data[:length])[0]
 
+############################################################################
+# TempoMap
+# time2tick and tick2time used to rescan every event of every track on each call.
+# A TempoMap is compiled once per file and then answers each lookup with a binary search.
+############################################################################
+class TempoMap:
+    '''
+    TempoMap(ticks, mspq, ticks_per_quarter)
+        ticks - tick positions of the tempo changes (sorted)
+        mspq - microseconds per quarter note set at each of those ticks
+        ticks_per_quarter - the PPQ of the midi file
+    Holds the cumulative tick/clock-time breakpoints of a tempo track. 
+    Ticks before the first tempo change use the first tempo, and a file without tempo changes gets the default 120 BPM. 
+    '''
+    def __init__(self, ticks, mspq, ticks_per_quarter):
+        if len(ticks) == 0:
+            ticks, mspq = [0], [500000]  # Default 120 BPM
+
+        self.ticks_per_quarter = ticks_per_quarter
+        self.start_ticks = [int(t) for t in ticks]
+        self.microsecondsPerQuarter = [int(m) for m in mspq]
+        self.microsecondsPerTick = [float(m) / ticks_per_quarter for m in mspq]
+
+        # clock time (in microseconds) at each breakpoint, accumulated segment by segment
+        self.start_us = [self.start_ticks[0] * self.microsecondsPerTick[0]]
+        for i in range(1, len(self.start_ticks)):
+            self.start_us.append(self.start_us[-1] + (self.start_ticks[i] - self.start_ticks[i-1]) * self.microsecondsPerTick[i-1])
+
+        # the same breakpoints as arrays for the batched (vectorized) lookups
+        self._start_ticks = np.array(self.start_ticks, dtype=np.int64)
+        self._start_us = np.array(self.start_us)
+        self._microsecondsPerTick = np.array(self.microsecondsPerTick)
+
+    @classmethod
+    def from_midifile(cls, mf):
+        '''
+        Compiles the tempo map of a music21 MidiFile that has already been read (mf.open(midi_file), mf.read())
+        '''
+        from music21 import midi
+
+        tempo_changes = []
+        for track in mf.tracks:
+            current_tick = 0  # delta times restart with each track
+            for event in track.events:
+                if isinstance(event, midi.DeltaTime):
+                    current_tick += event.time
+                elif event.type == midi.MetaEvents.SET_TEMPO:
+                    tempo_changes.append((current_tick, getNumber(event.data, 3)))  # microseconds per quarter note
+        tempo_changes.sort(key=lambda x: x[0])
+
+        return cls([t for t, _ in tempo_changes], [m for _, m in tempo_changes], mf.ticksPerQuarterNote)
+
+    def tick_to_seconds(self, tick):
+        '''
+        RETURNS: clock time in seconds at tick
+        '''
+        i = max(bisect.bisect_left(self.start_ticks, tick) - 1, 0)
+        return (self.start_us[i] + (tick - self.start_ticks[i]) * self.microsecondsPerTick[i]) / 1000000
+
+    def seconds_to_tick(self, seconds):
+        '''
+        RETURNS: the (integer) tick sounding at a clock time in seconds
+        '''
+        target_us = seconds * 1000000
+        i = max(bisect.bisect_right(self.start_us, target_us) - 1, 0)
+        return self.start_ticks[i] + int((target_us - self.start_us[i]) / self.microsecondsPerTick[i])
+
+    def ticks_to_seconds(self, ticks):
+        '''
+        Vectorized tick_to_seconds: one searchsorted over the breakpoints for a whole array of ticks
+        RETURNS: float array of clock times in seconds, same shape as ticks
+        '''
+        ticks = np.asarray(ticks)
+        i = np.maximum(np.searchsorted(self._start_ticks, ticks, side='right') - 1, 0)
+        return (self._start_us[i] + (ticks - self._start_ticks[i]) * self._microsecondsPerTick[i]) / 1000000
+
+    def seconds_to_ticks(self, seconds, fractional=False):
+        '''
+        Vectorized seconds_to_tick: one searchsorted over the breakpoints for a whole array of clock times
+            fractional - if True, return the exact (float) tick position rather than truncating to the sounding tick
+        RETURNS: int64 (or float) array of ticks, same shape as seconds
+        '''
+        target_us = np.asarray(seconds, dtype=float) * 1000000
+        i = np.maximum(np.searchsorted(self._start_us, target_us, side='right') - 1, 0)
+        ticks = (target_us - self._start_us[i]) / self._microsecondsPerTick[i]
+        if fractional:
+            return self._start_ticks[i] + ticks
+        return self._start_ticks[i] + ticks.astype(np.int64)
+
+
+# Compiled tempo maps, cached per (open) music21 MidiFile so repeated calls in a tight loop only build one
+_tempo_map_cache = weakref.WeakKeyDictionary()
+
+def get_tempo_map(mf):
+    '''
+    get_tempo_map(mf)
+        mf - already read with music21.midi: mf = MidiFile(), mf.open(midi_file), mf.read()
+             (or a ParsedMidi, or a midi file path)
+    RETURNS: the TempoMap for mf, built on first use and cached for as long as mf is alive
+    '''
+    if isinstance(mf, (ParsedMidi, str, os.PathLike)):
+        return parse_midi(mf).tempo_map
+
+    tempo_map = _tempo_map_cache.get(mf)
+    if tempo_map is None:
+        tempo_map = TempoMap.from_midifile(mf)
+        _tempo_map_cache[mf] = tempo_map
+    return tempo_map
+
+
 ################
 # Gets the tick number for a clock time value in (an open) music21 MidiFile
-# The function tends to get called many times in a tight loop, so assumes the midi file is open and read already
+# The function tends to get called many times in a tight loop, so the tempo map is compiled once and cached
 def time2tick(mf, seconds):
     '''
     Gets the tick number for a clock time value in (an open) music21 MidiFile
     time2tick(mf, seconds)
-        mf - already read with music21.midi: mf = MidiFile(), mf.open(midi_file), mf.read()
+        mf - already read with music21.midi: mf = MidiFile(), mf.open(midi_file), mf.read() (or a ParsedMidi)
         seconds - the time at which you would like the corresponding tick 
     RETURNS: tick value for a clock time in a midi file
     '''
-
-    ticks_per_quarter = mf.ticksPerQuarterNote
-    tempo_events = []
-    current_tick = 0
-    
-    # Collect all tempo change events
-    for track in mf.tracks:
-        for event in track.events:
-            
-            if isinstance(event, midi.DeltaTime):
-                current_tick += event.time
-            elif event.type == midi.MetaEvents.SET_TEMPO:
-                mspq = getNumber(event.data, 3)  # microseconds per quarter note
-                microsecondsPerTick = float(mspq) / ticks_per_quarter
-                if len(tempo_events) == 0:
-                    segment_start_ms = current_tick * microsecondsPerTick
-                else:
-                    last_tempo = tempo_events[-1]
-                    segment_start_ms = last_tempo.start_ms + (current_tick - last_tempo.start_ticks) * last_tempo.microsecondsPerTick
-                tempo_events.append(TempoEntry(current_tick, segment_start_ms, microsecondsPerTick))
-    
-    # If no tempo events, use default tempo
-    if not tempo_events:
-        microsecondsPerTick = 500000 / ticks_per_quarter  # Default 120 BPM
-        tempo_events.append(TempoEntry(0, 0, microsecondsPerTick))
-    
-    # Convert input seconds to microseconds
-    target_ms = seconds * 1000000
-    
-    # Find the tempo segment for the target time
-    current_tempo = tempo_events[0]
-    for next_tempo in tempo_events[1:]:
-        if next_tempo.start_ms > target_ms:
-            break
-        current_tempo = next_tempo
-    
-    # Calculate the final tick
-    remaining_ms = target_ms - current_tempo.start_ms
-    additional_ticks = int(remaining_ms / current_tempo.microsecondsPerTick)
-    final_tick = current_tempo.start_ticks + additional_ticks
-    
-    return final_tick
+    return get_tempo_map(mf).seconds_to_tick(seconds)
 
 
 ############################################################################
 # tick2time
 ############################################################################
 # Gets the clock time for a particular tick value in (an open) music21 MidiFile
-# The function tends to get called many times in a tight loop, so assumes the midi file is open and read already
+# The function tends to get called many times in a tight loop, so the tempo map is compiled once and cached
 def tick2time(mf, tick_time):
     '''
     tick2time(mf, tick_time)
         Gets the clock time for a particular tick value in (an open) music21 MidiFile.
-        mf - midi file already read with music21.midi: mf = MidiFile(), mf.open(midi_file), mf.read()
+        mf - midi file already read with music21.midi: mf = MidiFile(), mf.open(midi_file), mf.read() (or a ParsedMidi)
         tick_time - tick number at which you would like the corresponding clock time 
     RETURNS: clock time at a particular tick in a midi file
     '''
+    return get_tempo_map(mf).tick_to_seconds(tick_time)
 
-    ticks_per_quarter = mf.ticksPerQuarterNote
-    
-    tempo_changes = []
-    current_tick = 0
-    
-    for track in mf.tracks:
-        for event in track.events:
-            if isinstance(event, midi.DeltaTime):
-                current_tick += event.time
-            elif event.type == midi.MetaEvents.SET_TEMPO:
-                tempo_changes.append((current_tick, tempo.MetronomeMark(number=60000000 // int.from_bytes(event.data, 'big'))))
-    
-    tempo_changes.sort(key=lambda x: x[0])
-    
-    if not tempo_changes:
-        tempo_changes.append((0, tempo.MetronomeMark(number=120)))
-    
-    total_seconds = 0
-    last_tick = 0
-    last_tempo = tempo_changes[0][1]
-    
-    for change_tick, new_tempo in tempo_changes:
-        if change_tick >= tick_time:
-            break
-        
-        tick_duration = change_tick - last_tick
-        time_duration = tick_duration * 60 / (last_tempo.number * ticks_per_quarter)
-        total_seconds += time_duration
-        
-        last_tick = change_tick
-        last_tempo = new_tempo
-    
-    remaining_ticks = tick_time - last_tick
-    remaining_seconds = remaining_ticks * 60 / (last_tempo.number * ticks_per_quarter)
-    
-    return total_seconds + remaining_seconds
+
+############################################################################
+# time2ticks, ticks2times
+# Batched versions of time2tick and tick2time for converting thousands of points in one call
+############################################################################
+def time2ticks(mf, seconds):
+    '''
+    time2ticks(mf, seconds)
+        mf - already read with music21.midi: mf = MidiFile(), mf.open(midi_file), mf.read() (or a ParsedMidi)
+        seconds - array of clock times
+    RETURNS: int64 array of the tick values for the clock times (same as calling time2tick on each)
+    '''
+    return get_tempo_map(mf).seconds_to_ticks(seconds)
+
+
+def ticks2times(mf, ticks):
+    '''
+    ticks2times(mf, ticks)
+        mf - already read with music21.midi: mf = MidiFile(), mf.open(midi_file), mf.read() (or a ParsedMidi)
+        ticks - array of tick numbers
+    RETURNS: float array of the clock times for the ticks (same as calling tick2time on each)
+    '''
+    return get_tempo_map(mf).ticks_to_seconds(ticks)
+
+
+############################################################################
+# ParsedMidi
+# Everything the functions in this module need from a midi file, read once. 
+# Every function that takes a midi file accepts either a path or a ParsedMidi, so a pipeline stage can pay the parse cost once.
+############################################################################
+
+# One row per note: start/end in ticks and seconds, plus what the note-on said (channel is 0-based, as in the file)
+NOTE_DTYPE = np.dtype([("start_tick", np.int64), ("end_tick", np.int64), ("start", np.float64), ("end", np.float64),
+                       ("pitch", np.uint8), ("velocity", np.uint8), ("channel", np.uint8), ("track", np.uint16)])
+
+class ParsedMidi:
+    '''
+    ParsedMidi(midi_file)
+        midi_file - path to a midi file, read (once) with the struct-based smfreader
+    Attributes:
+        path - the midi file
+        ticks_per_quarter - the PPQ of the file
+        tempo_map - TempoMap of the file
+        time_signatures - TimeSignatureMap of the file
+        total_ticks - number of ticks in the longest track
+        notes - structured array (NOTE_DTYPE) of every note, sorted by start time
+        smf - the smfreader.SMF with the raw event table of every track
+    '''
+    def __init__(self, midi_file):
+        smf = SMF(midi_file)
+
+        self.path = midi_file
+        self.smf = smf
+        self.ticks_per_quarter = smf.ticks_per_quarter
+
+        tempo_ticks, tempo_data = smf.meta_events(smfreader.SET_TEMPO)
+        self.tempo_map = TempoMap(tempo_ticks, [getNumber(data, 3) for data in tempo_data], smf.ticks_per_quarter)
+
+        # time signature data is numerator, then the denominator as a power of 2
+        ts_ticks, ts_data = smf.meta_events(smfreader.TIME_SIGNATURE)
+        self.time_signatures = TimeSignatureMap(ts_ticks, [data[0] for data in ts_data], [2 ** data[1] for data in ts_data], smf.ticks_per_quarter)
+
+        self.total_ticks = max(smf.end_ticks(), default=0)
+        self.notes = self._read_notes(smf)
+
+    def _read_notes(self, smf):
+        rows = []
+        for track_index, track in enumerate(smf.tracks):
+            note_events = track[(track["type"] == smfreader.NOTE_ON) | (track["type"] == smfreader.NOTE_OFF)]
+            events = {}
+            for t, kind, channel, pitch, velocity in zip(note_events["abs_tick"].tolist(), note_events["type"].tolist(),
+                                                         note_events["channel"].tolist(), note_events["pitch"].tolist(), note_events["velocity"].tolist()):
+                note_key = (pitch, channel)
+                if kind == smfreader.NOTE_ON and velocity > 0:
+                    if not note_key in events:
+                        events[note_key] = [(t, velocity)]
+                    else:
+                        events[note_key].append((t, velocity))
+                elif note_key in events:
+                    # a note-off (or note-on with velocity 0) ends every sounding note-on of the same pitch and channel
+                    for start_tick, start_velocity in events[note_key]:
+                        if t > start_tick:
+                            rows.append((start_tick, t, 0.0, 0.0, pitch, start_velocity, channel, track_index))
+                    del events[note_key]
+
+        notes = np.array(rows, dtype=NOTE_DTYPE)
+        notes["start"] = self.tempo_map.ticks_to_seconds(notes["start_tick"])
+        notes["end"] = self.tempo_map.ticks_to_seconds(notes["end_tick"])
+        return notes[np.argsort(notes["start"], kind="stable")]
+
+    ############################
+    # The following methods are just for storing a ParsedMidi in the midicache and getting it back
+    ############################
+    def to_arrays(self):
+        '''
+        RETURNS: (arrays, info) - the parse as a dict of numpy arrays plus a json-able dict of the rest
+        '''
+        smf = self.smf
+        arrays = {
+            "events": np.concatenate(smf.tracks) if smf.tracks else np.empty(0, dtype=smfreader.EVENT_DTYPE),
+            "track_lengths": np.array([len(track) for track in smf.tracks], dtype=np.int64),
+            "data": np.frombuffer(smf.data, dtype=np.uint8),
+            "notes": self.notes,
+            "tempo_ticks": np.array(self.tempo_map.start_ticks, dtype=np.int64),
+            "tempo_mspq": np.array(self.tempo_map.microsecondsPerQuarter, dtype=np.int64),
+            # without the default 4/4 the map keeps in front
+            "ts_ticks": self.time_signatures.ticks[1:],
+            "ts_numerators": self.time_signatures.numerators[1:],
+            "ts_denominators": self.time_signatures.denominators[1:],
+        }
+        info = {"format": smf.format, "ticks_per_quarter": self.ticks_per_quarter, "total_ticks": int(self.total_ticks),
+                "track_chunks": [list(chunk) for chunk in smf.track_chunks]}
+        return arrays, info
+
+    @classmethod
+    def from_arrays(cls, midi_file, arrays, info):
+        '''
+        Rebuilds a ParsedMidi from to_arrays() output (eg memory mapped from the midicache) without parsing the file
+        '''
+        parsed = cls.__new__(cls)
+        ppq = info["ticks_per_quarter"]
+        parsed.path = midi_file
+        parsed.smf = SMF.from_arrays(midi_file, arrays["data"], arrays["events"], arrays["track_lengths"], info["format"], ppq, info["track_chunks"])
+        parsed.ticks_per_quarter = ppq
+        parsed.tempo_map = TempoMap(arrays["tempo_ticks"], arrays["tempo_mspq"], ppq)
+        parsed.time_signatures = TimeSignatureMap(arrays["ts_ticks"], arrays["ts_numerators"], arrays["ts_denominators"], ppq)
+        parsed.total_ticks = info["total_ticks"]
+        parsed.notes = arrays["notes"]
+        return parsed
+
+    def __repr__(self):
+        return f"ParsedMidi({self.path}, notes={len(self.notes)}, total_ticks={self.total_ticks})"
+
+
+def parse_midi(midi_file):
+    '''
+    parse_midi(midi_file)
+        midi_file - path to a midi file, or a ParsedMidi
+    RETURNS: a ParsedMidi (a ParsedMidi passed in is returned as is, so functions can call this on whatever they are given)
+    If the midicache is turned on (SCORETIMING_MIDI_CACHE), a file parsed before is memory mapped from the cache instead.
+    '''
+    if isinstance(midi_file, ParsedMidi):
+        return midi_file
+    if midicache.cache_dir() is None:
+        return ParsedMidi(midi_file)
+
+    key = midicache.file_key(midi_file, smfreader.PARSER_VERSION)
+    cached = midicache.load_bundle(key)
+    if cached is not None:
+        return ParsedMidi.from_arrays(midi_file, *cached)
+
+    parsed = ParsedMidi(midi_file)
+    midicache.save_bundle(key, *parsed.to_arrays())
+    return parsed
 
 
 ############################################################################
@@ -478,28 +974,41 @@ class Frame:
     def to_dict(self):
         return {attr: getattr(self, attr) for attr in vars(self) if not attr.startswith('_')}
 
+    # fname ending in .npy means the uncompressed, memory-mappable FrameTable format (see FrameTable.save)
     @classmethod
-    def save_frames(cls, frames, fname):
+    def save_frames(cls, frames, fname, compressed=True):
+        if isinstance(frames, FrameTable):
+            # already one array per column
+            frames.save(fname, compressed=compressed)
+            return
         if not frames:
             raise ValueError("No frames to save")
+        if fname.lower().endswith('.npy') or any(isinstance(frame, FrameRow) for frame in frames):
+            # (FrameRows keep their values in their table, so vars() of one has no columns to save)
+            FrameTable.from_frames(frames).save(fname, compressed=compressed)
+            return
         
         data = {attr: np.array([getattr(frame, attr) for frame in frames])
                 for attr in vars(frames[0]) if not attr.startswith('_')}
         
         fname=addExtensionIfNeeded(fname, 'npz')
-        np.savez_compressed(fname, **data)
+        if compressed:
+            np.savez_compressed(fname, **data)
+        else:
+            np.savez(fname, **data)
 
     @classmethod
     def load_frames(cls, fname):
+        if fname.lower().endswith('.npy'):
+            return FrameTable.load(fname).to_frames()
+
         fname=addExtensionIfNeeded(fname, 'npz')
-        loaded_data = np.load(fname)
+        # Every loaded_data[key] reads (and decompresses) that member of the archive again, so take each column just once
+        with np.load(fname) as loaded_data:
+            columns = {key: loaded_data[key] for key in loaded_data.files}
         
-        frames = []
-        for i in range(len(next(iter(loaded_data.values())))):
-            frame_data = {key: loaded_data[key][i] for key in loaded_data.keys()}
-            frames.append(cls.from_dict(frame_data))
-        
-        return frames
+        keys = list(columns.keys())
+        return [cls.from_dict(dict(zip(keys, values))) for values in zip(*columns.values())]
 
 
     # # Usage example for saving and loadiing:
@@ -524,24 +1033,227 @@ class Frame:
 
 
 
-# Creates a list of frames with start, end, and middle tick clock times for a midi file (with its evolving ticks-per-time)
+############################################################################
+# FrameTable
+# A list of Frame objects costs a python object (and __dict__) per frame, and every stage walks it attribute by attribute.
+# A FrameTable keeps the same fields as typed columns of one structured array (40 bytes a frame), so whole columns
+# can be computed at once, while indexing a single row still gives something that behaves like a Frame.
+############################################################################
+# measure and beat are float so that "not known yet" can stay NaN, as it is on a Frame.
+# Times stay float64: they are compared for ties against event times (measureBeats2frameList), and float32 can not hold
+# millisecond times past about an hour.
+FRAME_DTYPE = np.dtype([("num", np.int32), ("sTk", np.int32), ("sTm", np.float64), ("mTk", np.int32), ("mTm", np.float64),
+                        ("measure", np.float32), ("beat", np.float32), ("refframe", np.int32)])
+
+
+class FrameRow(Frame):
+    '''
+    FrameRow(table, i)
+        A Frame-like view of row i of a FrameTable: reading or setting frame.beat (etc.) reads or writes the table.
+    '''
+    __slots__ = ("_table", "_i")
+
+    def __init__(self, table, i):
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_i", i)
+
+    def __getattr__(self, name):
+        if name in FRAME_DTYPE.names:
+            return self._table.data[name][self._i].item()
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name not in FRAME_DTYPE.names:
+            raise AttributeError(f"FrameRow has no field {name}")
+        self._table.data[name][self._i] = value
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in FRAME_DTYPE.names}
+
+
+class FrameTable:
+    '''
+    FrameTable(n=0)
+        n frames numbered 0..n-1, ticks and refframe 0, times, measure and beat NaN
+    Columns (FRAME_DTYPE): num, sTk, sTm, mTk, mTm, measure, beat, refframe
+        table["mTk"] - a column (a view: table["beat"][:] = ... or table["beat"] = ... writes it)
+        table[i] - a FrameRow, which looks like a Frame
+        table[i:j], table[mask] - a FrameTable of those rows
+        iterating gives FrameRows, so code written for lists of Frame keeps working
+    save()/load() write and read one array per column, the same .npz layout as Frame.save_frames/load_frames,
+    or, for a name ending in .npy, the structured array itself: uncompressed, and memory mapped by load().
+    '''
+    def __init__(self, n=0):
+        self.data = np.zeros(n, dtype=FRAME_DTYPE)
+        self.data["num"] = np.arange(n)
+        for name in ("sTm", "mTm", "measure", "beat"):
+            self.data[name] = np.nan
+
+    @classmethod
+    def from_array(cls, data):
+        table = cls.__new__(cls)
+        table.data = data
+        return table
+
+    @classmethod
+    def from_columns(cls, **columns):
+        '''
+        FrameTable.from_columns(num=..., sTk=..., ...) - any columns left out get the FrameTable(n) defaults
+        '''
+        n = len(next(iter(columns.values()))) if columns else 0
+        table = cls(n)
+        for name, column in columns.items():
+            table.data[name] = column
+        return table
+
+    @classmethod
+    def from_frames(cls, frames):
+        return cls.from_columns(**{name: [getattr(frame, name) for frame in frames] for name in FRAME_DTYPE.names})
+
+    def to_frames(self):
+        '''
+        RETURNS: a list of (independent) Frame objects with the same values
+        '''
+        columns = [self.data[name].tolist() for name in FRAME_DTYPE.names]
+        return [Frame(*values) for values in zip(*columns)]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.data[key]
+        if isinstance(key, (int, np.integer)):
+            return FrameRow(self, int(key) if key >= 0 else len(self) + int(key))
+        return FrameTable.from_array(self.data[key])
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield FrameRow(self, i)
+
+    def __repr__(self):
+        return f"FrameTable({len(self)} frames)"
+
+    def save(self, fname, compressed=True):
+        '''
+        save(fname, compressed=True)
+            Writes each column as one array in an .npz (readable by Frame.load_frames too),
+            or if fname ends in .npy, the whole table as one uncompressed structured array that load() can memory map
+            (for per-variant frame files that are written and read over and over)
+        '''
+        if len(self) == 0:
+            raise ValueError("No frames to save")
+        if fname.lower().endswith('.npy'):
+            np.save(fname, self.data)
+            return
+        fname=addExtensionIfNeeded(fname, 'npz')
+        columns = {name: self.data[name] for name in FRAME_DTYPE.names}
+        if compressed:
+            np.savez_compressed(fname, **columns)
+        else:
+            np.savez(fname, **columns)
+
+    @classmethod
+    def load(cls, fname, mmap=True):
+        '''
+        FrameTable.load(fname, mmap=True) - reads a frames .npz written by save() or Frame.save_frames, or a .npy table.
+            A .npy is memory mapped copy-on-write when mmap is True: rows are read as they are touched,
+            and changes to the table never go back to the file.
+        '''
+        if fname.lower().endswith('.npy'):
+            data = np.load(fname, mmap_mode='c' if mmap else None)
+            if data.dtype != FRAME_DTYPE:
+                raise ValueError(f"{fname} is not a FrameTable (dtype {data.dtype})")
+            return cls.from_array(data)
+
+        fname=addExtensionIfNeeded(fname, 'npz')
+        with np.load(fname) as loaded:
+            return cls.from_columns(**{name: loaded[name] for name in loaded.files if name in FRAME_DTYPE.names})
+
+
+# Creates a FrameTable of frames with start and middle ticks and clock times for a midi file (with its evolving ticks-per-time)
 def midi2frameskeleton(midi_file, fps) :
+    parsed = parse_midi(midi_file)
 
-    mf = MidiFile()
-    mf.open(midi_file)
-    mf.read()
+    maxTick=parsed.total_ticks
+    maxTime=parsed.tempo_map.tick_to_seconds(maxTick)
 
+    # frame k starts at exactly k/fps (rather than a running sum of 1/fps, which drifts over a long piece),
+    # and the start and middle times are converted to ticks in two batched calls
+    nframes = int(np.ceil(maxTime*fps))
+    times = np.arange(nframes)/fps
+    mid_times = (np.arange(nframes) + 0.5)/fps
 
-    maxTick=count_total_ticks(midi_file)
-    maxTime=tick2time(mf, maxTick)
-    
-    fdur=1/fps
-    halffdur=fdur/2
-    
-    framelist=[]
+    frames = FrameTable(nframes)
+    frames["sTk"] = parsed.tempo_map.seconds_to_ticks(times)
+    frames["sTm"] = np.round(times, 3)
+    frames["mTk"] = parsed.tempo_map.seconds_to_ticks(mid_times)
+    frames["mTm"] = np.round(mid_times, 3)
+    frames["refframe"] = frames["num"]
+    return frames
 
-    for i, t in enumerate(float_range(0, maxTime, fdur)):
-        frame=Frame(i, time2tick(mf,t), round(t, 3), time2tick(mf,t+halffdur), round((t+halffdur), 3), refframe=i)
-        framelist.append(frame)
-    return framelist
 
+
+############################################################################
+# Ground truth straight from the tempo maps
+# A tempo variant (tempoVariator_*) has exactly the reference's ticks and only a different tempo track, so the
+# reference frame for each variant frame is just variant time -> tick (variant tempo map) -> reference time -> frame.
+############################################################################
+def groundtruth_from_tempo_maps(ref_midi, var_midi, fps_ref, fps_var):
+    '''
+    groundtruth_from_tempo_maps(ref_midi, var_midi, fps_ref, fps_var)
+        ref_midi, var_midi - paths (or ParsedMidi) of the reference and of a tempo variant of it
+        fps_ref, fps_var - frame rates of the reference frames and of the variant frames
+    Frames are laid out as in midi2frameskeleton (frame k spans k/fps to (k+1)/fps), and each variant frame is
+    placed by its middle, through its exact (fractional) tick, on the reference's time line.
+    RETURNS: (refframe, refframe_frac), one per variant frame:
+        refframe - int64 index of the reference frame whose middle is closest (ties to the earlier frame, clipped
+            to the reference frames), what frameMatch computes from the two frame lists
+        refframe_frac - the fractional reference frame position (0.0 is the middle of reference frame 0)
+    '''
+    ref = parse_midi(ref_midi)
+    var = parse_midi(var_midi)
+
+    nref = int(np.ceil(ref.tempo_map.tick_to_seconds(ref.total_ticks)*fps_ref))
+    nvar = int(np.ceil(var.tempo_map.tick_to_seconds(var.total_ticks)*fps_var))
+
+    var_ticks = var.tempo_map.seconds_to_ticks((np.arange(nvar) + 0.5)/fps_var, fractional=True)
+    refframe_frac = ref.tempo_map.ticks_to_seconds(var_ticks)*fps_ref - 0.5
+    refframe = np.clip(np.ceil(refframe_frac - 0.5), 0, nref - 1).astype(np.int64)
+    return refframe, refframe_frac
+
+# Frame skeletons at several frame rates from one parse (and so one tempo map)
+def midi2frameskeletons(midi_file, rates) :
+    parsed = parse_midi(midi_file)
+    return {fps: midi2frameskeleton(parsed, fps) for fps in rates}
+
+
+def frame_rate(value):
+    '''
+    frame_rate(value) - a frame rate from the command line: frames per second ("86.133") or sample_rate/hop_length ("44100/512")
+    Raises ValueError (which argparse reports as a usage error) for anything that is not a positive, finite rate
+    '''
+    if '/' in str(value):
+        sample_rate, hop_length = str(value).split('/')
+        if float(hop_length) == 0:
+            raise ValueError(f"frame rate {value} has a hop length of 0")
+        fps = float(sample_rate)/float(hop_length)
+    else:
+        fps = float(value)
+    if not (0 < fps < float('inf')):
+        raise ValueError(f"frame rate {value} is not a positive number of frames per second")
+    return fps
+
+
+def rate_tag(value):
+    '''
+    rate_tag(value) - a frame rate as a short string for file names and metadata: fps to 3 decimals ("86.133"),
+        but a rate given as sample_rate/hop_length keeps that form ("44100/512" -> "44100_512"), so it can't collide with one given as fps
+    '''
+    if '/' in str(value):
+        sample_rate, hop_length = str(value).split('/')
+        return f"{sample_rate.strip()}_{hop_length.strip()}"
+    return f"{float(value):.3f}".rstrip('0').rstrip('.')
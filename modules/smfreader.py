@@ -0,0 +1,172 @@
+# module smfreader.py
+#
+# A Standard MIDI File reader built on struct (in the spirit of pyutils/midiheader.py) that decodes
+# every track straight into a NumPy structured array of events, without building an object per event.
+
+import struct
+import numpy as np
+
+
+# bump this whenever the decoded tables change, so cached parses (see midicache.py) are not reused
+PARSER_VERSION = 1
+
+
+#################################################################################
+# Event table
+#################################################################################
+# type is the status nibble for channel messages (0x80 note off, 0x90 note on, 0xA0 ... 0xE0),
+# META (0xFF) for meta events, and 0xF0/0xF7 for sysex.
+# pitch and velocity hold the two data bytes of channel messages (controller/value for 0xB0, program for 0xC0, ...).
+# meta events keep their type in meta_type; the payload of meta and sysex events is data[meta_offset:meta_offset+meta_length]
+EVENT_DTYPE = np.dtype([("abs_tick", np.int64), ("type", np.uint8), ("channel", np.uint8), ("pitch", np.uint8), ("velocity", np.uint8),
+                        ("meta_type", np.uint8), ("meta_offset", np.int64), ("meta_length", np.int32)])
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+META = 0xFF
+
+# meta event types
+SET_TEMPO = 0x51
+TIME_SIGNATURE = 0x58
+END_OF_TRACK = 0x2F
+
+# number of data bytes that follow each channel message status
+_DATA_BYTES = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+
+def _read_vlq(data, pos):
+    # variable length quantity: 7 bits per byte, high bit set on all but the last byte
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def _read_track(data, pos, end):
+    '''
+    Decodes the events of one MTrk chunk (data[pos:end]) into an EVENT_DTYPE array
+    '''
+    rows = []
+    abs_tick = 0
+    running_status = None
+
+    while pos < end:
+        delta, pos = _read_vlq(data, pos)
+        abs_tick += delta
+
+        status = data[pos]
+        if status < 0x80:
+            # running status: reuse the last channel status, this byte is already data
+            if running_status is None:
+                raise ValueError(f"Running status data byte with no previous status at byte {pos}")
+            status = running_status
+        else:
+            pos += 1
+
+        if status == META:
+            meta_type = data[pos]
+            length, pos = _read_vlq(data, pos + 1)
+            rows.append((abs_tick, META, 0, 0, 0, meta_type, pos, length))
+            pos += length
+            if meta_type == END_OF_TRACK:
+                break
+        elif status == 0xF0 or status == 0xF7:
+            length, pos = _read_vlq(data, pos)
+            rows.append((abs_tick, status, 0, 0, 0, 0, pos, length))
+            pos += length
+        elif status < 0xF0:
+            running_status = status
+            kind = status & 0xF0
+            if _DATA_BYTES[kind] == 2:
+                rows.append((abs_tick, kind, status & 0x0F, data[pos], data[pos + 1], 0, 0, 0))
+                pos += 2
+            else:
+                rows.append((abs_tick, kind, status & 0x0F, data[pos], 0, 0, 0, 0))
+                pos += 1
+        else:
+            raise ValueError(f"Unexpected status byte {status:#x} in track data at byte {pos - 1}")
+
+    return np.array(rows, dtype=EVENT_DTYPE)
+
+
+#################################################################################
+# SMF
+#################################################################################
+class SMF:
+    '''
+    SMF(midi_file)
+        midi_file - path to a Standard MIDI File (format 0 or 1, PPQ division)
+    Attributes:
+        format - midi file format (0, 1, or 2)
+        ticks_per_quarter - the PPQ of the file
+        tracks - list of EVENT_DTYPE arrays, one per track, in file order
+        track_chunks - list of (offset, length) of each MTrk chunk (header included) in data
+        data - the raw bytes of the file (meta_offset values index into this)
+    '''
+    def __init__(self, midi_file):
+        with open(midi_file, 'rb') as f:
+            self.data = f.read()
+        self.path = midi_file
+
+        data = self.data
+        chunk_type, header_length, self.format, num_tracks, division = struct.unpack('>4sLHHH', data[:14])
+        if chunk_type != b'MThd':
+            raise ValueError(f"{midi_file} does not appear to be a valid MIDI file.")
+        if division & 0x8000:
+            raise ValueError(f"{midi_file} uses SMPTE time division, only PPQ is supported.")
+        self.ticks_per_quarter = division & 0x7FFF
+
+        self.tracks = []
+        self.track_chunks = []
+        pos = 8 + header_length
+        while pos + 8 <= len(data) and len(self.tracks) < num_tracks:
+            chunk_type, length = struct.unpack('>4sL', data[pos:pos + 8])
+            if chunk_type == b'MTrk':
+                self.track_chunks.append((pos, 8 + length))
+                self.tracks.append(_read_track(data, pos + 8, min(pos + 8 + length, len(data))))
+            # anything other than MTrk is an unknown chunk, which the standard says to skip
+            pos += 8 + length
+
+    @classmethod
+    def from_arrays(cls, path, data, events, track_lengths, format, ticks_per_quarter, track_chunks):
+        '''
+        Rebuilds an SMF from its tables (eg memory mapped from the midicache) without decoding the file again
+            data - the raw file bytes (bytes or a uint8 array)
+            events - all the track arrays concatenated, with track_lengths the number of events in each
+        '''
+        smf = cls.__new__(cls)
+        smf.path = path
+        smf.data = data
+        smf.format = format
+        smf.ticks_per_quarter = ticks_per_quarter
+        smf.track_chunks = [tuple(chunk) for chunk in track_chunks]
+        smf.tracks = np.split(events, np.cumsum(track_lengths)[:-1]) if len(track_lengths) else []
+        return smf
+
+    def payload(self, event):
+        '''
+        RETURNS: the bytes carried by a meta or sysex event (a row of one of the track arrays)
+        '''
+        return bytes(self.data[event["meta_offset"]:event["meta_offset"] + event["meta_length"]])
+
+    def meta_events(self, meta_type):
+        '''
+        RETURNS: (abs_ticks, payloads) of all meta events of meta_type across all tracks,
+            stably sorted by tick (so events at the same tick stay in track order)
+        '''
+        events = np.concatenate([track[(track["type"] == META) & (track["meta_type"] == meta_type)] for track in self.tracks]) \
+            if self.tracks else np.empty(0, dtype=EVENT_DTYPE)
+        events = events[np.argsort(events["abs_tick"], kind="stable")]
+        return events["abs_tick"], [self.payload(event) for event in events]
+
+    def end_ticks(self):
+        '''
+        RETURNS: the tick of the last event in each track
+        '''
+        return [int(track["abs_tick"][-1]) if len(track) else 0 for track in self.tracks]
+
+    def __repr__(self):
+        return f"SMF({self.path}, format={self.format}, ticks_per_quarter={self.ticks_per_quarter}, tracks={len(self.tracks)})"
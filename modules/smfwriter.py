@@ -0,0 +1,212 @@
+# module smfwriter.py
+#
+# The writing side of smfreader.py: encodes tracks from arrays (absolute ticks plus event bytes) in bulk with numpy,
+# instead of serializing one message object at a time. Tracks that do not change are copied from the input file as raw bytes.
+# Used by the tempo variators to rewrite track 0 (the tempo track) of a file and leave the note tracks alone.
+
+import struct
+import numpy as np
+
+from modules.smfreader import META, SET_TEMPO, END_OF_TRACK, _DATA_BYTES
+
+
+TEXT = 0x01
+
+
+def _ranges(starts, lengths):
+    # indices starts[0] ... starts[0]+lengths[0]-1, starts[1] ..., concatenated
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    return np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+
+
+def encode_vlq(values):
+    '''
+    encode_vlq(values)
+    RETURNS: (bytes, lengths) - the variable length quantities of all the values concatenated into one uint8 array,
+        and the number of bytes of each (1 to 4, so values must be below 2**28)
+    '''
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) and (values.min() < 0 or values.max() >= 1 << 28):
+        raise ValueError("Variable length quantities must be in [0, 2**28)")
+    lengths = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    byte_index = _ranges(np.zeros(len(values), dtype=np.int64), lengths)
+    last = np.repeat(lengths - 1, lengths)
+    shift = 7 * (last - byte_index)
+    vlq = (np.repeat(values, lengths) >> shift) & 0x7F | np.where(byte_index < last, 0x80, 0)
+    return vlq.astype(np.uint8), lengths
+
+
+#################################################################################
+# Events
+#################################################################################
+# A set of events is (status, body, lengths): status is the status byte of channel messages (0 for meta and sysex events),
+# body is the bytes after the status of every event concatenated (all of the bytes for meta and sysex events),
+# and lengths the number of body bytes of each. Keeping the status apart lets encode_track use running status.
+
+def encode_events(smf, events, tempos=None):
+    '''
+    encode_events(smf, events, tempos=None)
+        events - rows of one of smf's track arrays (EVENT_DTYPE)
+        tempos - new microseconds per quarter for the set_tempo events among them, in order (None: keep them)
+    RETURNS: (status, body, lengths) of the events
+    '''
+    n = len(events)
+    channel = events["type"] < 0xF0
+    status = np.where(channel, events["type"] | events["channel"], 0).astype(np.uint8)
+
+    # channel messages: their one or two data bytes
+    data_bytes = np.array([_DATA_BYTES.get(kind, 0) for kind in range(0x100)], dtype=np.int64)[events["type"][channel]]
+    data = np.stack((events["pitch"][channel], events["velocity"][channel]), axis=1)
+    channel_body = data[np.arange(2) < data_bytes[:, None]]
+
+    # meta and sysex events: built one at a time, but there are few of them
+    others = np.flatnonzero(~channel)
+    is_tempo = (events["type"][others] == META) & (events["meta_type"][others] == SET_TEMPO)
+    if tempos is not None and len(tempos) != is_tempo.sum():
+        raise ValueError(f"{len(tempos)} tempos given for {is_tempo.sum()} set_tempo events")
+    tempo_iter = iter([] if tempos is None else tempos)
+    pieces = []
+    for i, tempo_event in zip(others.tolist(), is_tempo.tolist()):
+        event = events[i]
+        if tempo_event and tempos is not None:
+            pieces.append(bytes([META, SET_TEMPO, 3]) + int(next(tempo_iter)).to_bytes(3, 'big'))
+        elif event["type"] == META:
+            vlq, _ = encode_vlq([event["meta_length"]])
+            pieces.append(bytes([META, event["meta_type"]]) + vlq.tobytes() + smf.payload(event))
+        else:
+            vlq, _ = encode_vlq([event["meta_length"]])
+            pieces.append(bytes([event["type"]]) + vlq.tobytes() + smf.payload(event))
+    other_body = np.frombuffer(b''.join(pieces), dtype=np.uint8)
+
+    # put the two groups back in event order
+    lengths = np.zeros(n, dtype=np.int64)
+    lengths[channel] = data_bytes
+    lengths[others] = [len(piece) for piece in pieces]
+    order = np.concatenate((np.flatnonzero(channel), others))
+    body = np.empty(lengths.sum(), dtype=np.uint8)
+    body[_ranges((np.cumsum(lengths) - lengths)[order], lengths[order])] = np.concatenate((channel_body, other_body))
+    return status, body, lengths
+
+
+def tempo_events(tempos):
+    '''
+    RETURNS: (status, body, lengths) of set_tempo events for an array of microseconds per quarter
+    '''
+    tempos = np.asarray(tempos, dtype=np.int64)
+    if len(tempos) and (tempos.min() < 0 or tempos.max() >= 1 << 24):
+        raise ValueError("Tempos must fit in 3 bytes")
+    body = np.empty((len(tempos), 6), dtype=np.uint8)
+    body[:, :3] = (META, SET_TEMPO, 3)
+    body[:, 3] = tempos >> 16
+    body[:, 4] = (tempos >> 8) & 0xFF
+    body[:, 5] = tempos & 0xFF
+    return np.zeros(len(tempos), dtype=np.uint8), body.ravel(), np.full(len(tempos), 6, dtype=np.int64)
+
+
+def meta_event(meta_type, payload):
+    # (status, body, lengths) of a single meta event
+    vlq, _ = encode_vlq([len(payload)])
+    body = np.frombuffer(bytes([META, meta_type]) + vlq.tobytes() + payload, dtype=np.uint8)
+    return np.zeros(1, dtype=np.uint8), body, np.array([len(body)], dtype=np.int64)
+
+
+def merge_events(*groups):
+    '''
+    merge_events((ticks, (status, body, lengths)), ...)
+    RETURNS: (ticks, (status, body, lengths)) of all the groups' events sorted by tick; the sort is stable,
+        so events at the same tick keep their order within a group and earlier groups come first
+    '''
+    ticks = np.concatenate([np.asarray(group[0], dtype=np.int64) for group in groups])
+    status = np.concatenate([group[1][0] for group in groups])
+    body = np.concatenate([group[1][1] for group in groups])
+    lengths = np.concatenate([group[1][2] for group in groups])
+
+    order = np.argsort(ticks, kind="stable")
+    starts = (np.cumsum(lengths) - lengths)[order]
+    return ticks[order], (status[order], body[_ranges(starts, lengths[order])], lengths[order])
+
+
+#################################################################################
+# Tracks and files
+#################################################################################
+def encode_track(ticks, events, end_tick=None):
+    '''
+    encode_track(ticks, events, end_tick=None)
+        ticks - absolute tick of every event (sorted)
+        events - (status, body, lengths) of the events
+        end_tick - tick of the end_of_track event that is added (default: the last event's tick)
+    RETURNS: the bytes of the whole MTrk chunk, with running status (as mido writes it)
+    '''
+    status, body, lengths = events
+    ticks = np.asarray(ticks, dtype=np.int64)
+    end_tick = max(end_tick or 0, int(ticks[-1]) if len(ticks) else 0)
+    eot_status, eot_body, eot_lengths = meta_event(END_OF_TRACK, b'')
+    ticks = np.append(ticks, end_tick)
+    status = np.concatenate((status, eot_status))
+    body = np.concatenate((body, eot_body))
+    lengths = np.concatenate((lengths, eot_lengths))
+
+    vlq, vlq_lengths = encode_vlq(np.diff(ticks, prepend=0))
+    # a channel status byte is left out when it repeats the one before (meta and sysex events cancel running status)
+    show = (status > 0) & (status != np.concatenate(([0], status[:-1])))
+    event_lengths = vlq_lengths + show + lengths
+    starts = np.cumsum(event_lengths) - event_lengths
+
+    data = np.empty(event_lengths.sum(), dtype=np.uint8)
+    data[_ranges(starts, vlq_lengths)] = vlq
+    data[(starts + vlq_lengths)[show]] = status[show]
+    data[_ranges(starts + vlq_lengths + show, lengths)] = body
+    return b'MTrk' + struct.pack('>L', len(data)) + data.tobytes()
+
+
+def track_chunk(smf, index):
+    '''
+    RETURNS: the raw bytes of track index's MTrk chunk in the file smf was read from
+    '''
+    offset, length = smf.track_chunks[index]
+    return bytes(smf.data[offset:offset + length])
+
+
+def write_smf(fname, format, ticks_per_quarter, chunks):
+    '''
+    write_smf(fname, format, ticks_per_quarter, chunks)
+        chunks - the MTrk chunks (bytes from encode_track or track_chunk), in order
+    '''
+    with open(fname, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>LHHH', 6, format, len(chunks), ticks_per_quarter))
+        for chunk in chunks:
+            f.write(chunk)
+
+
+def write_with_track(smf, fname, index, chunk):
+    '''
+    Writes smf to fname with track index replaced by chunk, and every other track copied byte for byte
+    '''
+    chunks = [chunk if i == index else track_chunk(smf, i) for i in range(len(smf.tracks))]
+    write_smf(fname, smf.format, smf.ticks_per_quarter, chunks)
+
+
+def rewrite_tempo_track(smf, new_ticks, new_tempos, tempos=None, index=0, pad_to=None, pad_text=None):
+    '''
+    rewrite_tempo_track(smf, new_ticks, new_tempos, tempos=None, index=0, pad_to=None, pad_text=None)
+    Merges new set_tempo events into track index. The track's own events keep their ticks and bytes, except that
+    its set_tempo events take the values in tempos (if given), and its end_of_track is dropped and a single one
+    is written again at the end (at the later of its old tick and the last event).
+        new_ticks, new_tempos - the new set_tempo events (put before any original event at the same tick)
+        tempos - replacement microseconds per quarter for the track's own set_tempo events, in order (None: keep them)
+        pad_to, pad_text - if the track ends before tick pad_to, a text event pad_text is put there (and the end_of_track with it)
+    RETURNS: the bytes of the new MTrk chunk
+    '''
+    events = smf.tracks[index]
+    eot = (events["type"] == META) & (events["meta_type"] == END_OF_TRACK)
+    end_tick = int(events["abs_tick"].max(initial=0))
+    kept = events[~eot]
+
+    groups = [(new_ticks, tempo_events(new_tempos)), (kept["abs_tick"], encode_events(smf, kept, tempos))]
+    if pad_text != None and pad_to != None and end_tick < pad_to:
+        groups.append(([pad_to], meta_event(TEXT, pad_text.encode('latin1'))))
+        end_tick = pad_to
+
+    ticks, merged = merge_events(*groups)
+    return encode_track(ticks, merged, end_tick)
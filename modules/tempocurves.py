@@ -0,0 +1,299 @@
+# module tempocurves.py
+#
+# Tempo curves for the tempo variators (programs/tempoVariator_time.py and tempoVariator_ticks.py).
+# A curve maps an array of positions (seconds or ticks, whichever the variator works in) to tempo factors,
+# all at once with numpy. The variator divides the original tempo (microseconds per quarter) by the factor,
+# so a factor of 2 plays twice as fast. Curves are written in octaves: 2**(value) is the factor.
+#
+# Curves are looked up by name in CURVES, so a new one is just a function with the @curve("name") decorator:
+#     @curve("mycurve")
+#     def mycurve(x, amplitude, ...):
+#         return 2 ** (...)
+
+import numpy as np
+
+
+CURVES = {}
+
+
+def curve(name):
+    '''
+    Decorator that registers a curve function f(x, **params) -> factors under name
+    '''
+    def register(f):
+        CURVES[name] = f
+        return f
+    return register
+
+
+#################################################################################
+# Curves
+#################################################################################
+@curve("sine")
+def sine(x, period, amplitude, phase=0.0):
+    '''
+    sine(x, period, amplitude, phase=0.0)
+    A sin wave interpreted as units in octaves (eg, amplitude 1 maps sin[-1,1] to [.5, 2]).
+    np.sin can differ from the scalar math.sin the variators used before by an ulp, so a tempo (whole microseconds)
+    can come out 1 µs away from the old scripts' output, near the sine's zero crossings.
+    '''
+    return 2 ** (amplitude * np.sin(2 * np.pi * np.asarray(x, dtype=float) / period + phase))
+
+
+@curve("sines")
+def sines(x, periods, amplitudes, phases=None):
+    '''
+    sines(x, periods, amplitudes, phases=None)
+    Sum of sin waves (in octaves), one per entry of periods/amplitudes (and phases, default 0)
+    '''
+    x = np.asarray(x, dtype=float)
+    periods = np.atleast_1d(np.asarray(periods, dtype=float))
+    amplitudes = np.broadcast_to(np.asarray(amplitudes, dtype=float), periods.shape)
+    phases = np.zeros_like(periods) if phases is None else np.broadcast_to(np.asarray(phases, dtype=float), periods.shape)
+    octaves = (amplitudes * np.sin(2 * np.pi * x[..., None] / periods + phases)).sum(axis=-1)
+    return 2 ** octaves
+
+
+@curve("smooth_random")
+def smooth_random(x, amplitude, scale, seed=0):
+    '''
+    smooth_random(x, amplitude, scale, seed=0)
+    Seeded value noise: uniform random values in [-amplitude, amplitude] octaves at every multiple of scale,
+    joined with a smoothstep, so the tempo wanders but has no corners. The same seed always gives the same curve.
+    '''
+    x = np.asarray(x, dtype=float) / scale
+    cell = np.floor(x).astype(np.int64)
+    knots = np.random.default_rng(int(seed)).uniform(-1, 1, int(max(cell.max(initial=0), 0)) + 2)
+    cell = np.clip(cell, 0, len(knots) - 2)
+    t = np.clip(x - cell, 0, 1)
+    t = t * t * (3 - 2 * t)
+    return 2 ** (amplitude * (knots[cell] * (1 - t) + knots[cell + 1] * t))
+
+
+@curve("piecewise_linear")
+def piecewise_linear(x, points, octaves):
+    '''
+    piecewise_linear(x, points, octaves)
+    Straight lines between (points[i], octaves[i]) - eg an accel. then a rit. - held flat before the first and after the last point
+    '''
+    return 2 ** np.interp(np.asarray(x, dtype=float), np.asarray(points, dtype=float), np.asarray(octaves, dtype=float))
+
+
+@curve("spline")
+def spline(x, points, octaves):
+    '''
+    spline(x, points, octaves)
+    Natural cubic spline through (points[i], octaves[i]), eg anchored on beats, held flat outside the points
+    '''
+    from scipy.interpolate import CubicSpline
+
+    points = np.asarray(points, dtype=float)
+    x = np.clip(np.asarray(x, dtype=float), points[0], points[-1])
+    return 2 ** CubicSpline(points, np.asarray(octaves, dtype=float), bc_type='natural')(x)
+
+
+#################################################################################
+# Using curves
+#################################################################################
+def tempo_factors(name, x, **params):
+    '''
+    tempo_factors(name, x, **params)
+    RETURNS: float array of the tempo factors of curve name at every position in x
+    '''
+    if name not in CURVES:
+        raise ValueError(f"Unknown tempo curve '{name}' (known curves: {', '.join(sorted(CURVES))})")
+    return CURVES[name](x, **params)
+
+
+def parse_params(items):
+    '''
+    parse_params(["period=5", "amplitudes=1,.5"]) -> {"period": 5.0, "amplitudes": [1.0, 0.5]}
+    Values with commas become lists of floats.
+    '''
+    params = {}
+    for item in items or []:
+        key, sep, value = item.partition('=')
+        if not sep:
+            raise ValueError(f"Curve parameter '{item}' is not of the form name=value")
+        params[key] = [float(v) for v in value.split(',')] if ',' in value else float(value)
+    return params
+
+
+def describe(name, params):
+    '''
+    RETURNS: json-able record of a curve for the variation metadata
+    '''
+    return {"curve": name, "params": params}
+
+
+class CurveSampler:
+    '''
+    CurveSampler(name, spacing, block=4096, **params)
+        Tempo factors at positions spacing, 2*spacing, 3*spacing, ... evaluated block positions at a time,
+        for when the last position is not known in advance (eg tempoVariator_time, where it depends on the new tempos)
+        sampler[k] - factor at (k+1)*spacing
+    '''
+    def __init__(self, name, spacing, block=4096, **params):
+        self.name = name
+        self.spacing = spacing
+        self.block = block
+        self.params = params
+        self.factors = np.empty(0)
+
+    def __getitem__(self, k):
+        while k >= len(self.factors):
+            positions = (np.arange(len(self.factors), len(self.factors) + self.block) + 1) * self.spacing
+            self.factors = np.concatenate((self.factors, tempo_factors(self.name, positions, **self.params)))
+        return self.factors[k]
+
+
+#################################################################################
+# Adaptive tempo events
+#################################################################################
+# Instead of a tempo event every spacing seconds or ticks, tempo events can go only where they are needed.
+# Given the time every tick should land on under the continuous curve, each event holds one tempo for as many
+# ticks as it can while every tick stays within tolerance seconds of its target time.
+
+def original_tempos(end_tick, tempo_ticks, tempos):
+    '''
+    RETURNS: the microseconds per quarter in effect at each tick 0 ... end_tick-1. Ticks before the first tempo change
+        use the first tempo (120 BPM without any), as in TempoMap and the variators' spacing mode
+    '''
+    tempos = np.asarray(tempos, dtype=np.int64)
+    lookup = np.concatenate((tempos[:1] if len(tempos) else [500000], tempos))
+    return lookup[np.searchsorted(np.asarray(tempo_ticks, dtype=np.int64), np.arange(end_tick), side='right')]
+
+
+def target_times_from_ticks(name, end_tick, tempo_ticks, tempos, ticks_per_quarter, **params):
+    '''
+    target_times_from_ticks(name, end_tick, tempo_ticks, tempos, ticks_per_quarter, **params)
+    RETURNS: the time of every tick 0 ... end_tick when the original tempo is divided by curve name at (the middle of) each tick
+    '''
+    seconds_per_tick = original_tempos(end_tick, tempo_ticks, tempos) * 1e-6 / ticks_per_quarter
+    seconds_per_tick = seconds_per_tick / tempo_factors(name, np.arange(end_tick) + 0.5, **params)
+    return np.concatenate(([0.0], np.cumsum(seconds_per_tick)))
+
+
+def target_times_from_seconds(name, end_tick, tempo_ticks, tempos, ticks_per_quarter, block=256, **params):
+    '''
+    target_times_from_seconds(name, end_tick, tempo_ticks, tempos, ticks_per_quarter, block=256, **params)
+    RETURNS: the time of every tick 0 ... end_tick when the curve is a function of the (new) time.
+        A tick's time depends on the factors before it, so this is solved block ticks at a time, by fixed point iteration
+    '''
+    seconds_per_tick = original_tempos(end_tick, tempo_ticks, tempos) * 1e-6 / ticks_per_quarter
+    times = np.zeros(end_tick + 1)
+    for start in range(0, end_tick, block):
+        unvaried = seconds_per_tick[start:start + block]
+        t = times[start] + np.concatenate(([0.0], np.cumsum(unvaried)))
+        for iteration in range(100):
+            factors = tempo_factors(name, (t[:-1] + t[1:]) / 2, **params)
+            new_t = times[start] + np.concatenate(([0.0], np.cumsum(unvaried / factors)))
+            converged = np.abs(new_t - t).max() < 1e-12
+            t = new_t
+            if converged:
+                break
+        times[start:start + len(t)] = t
+    return times
+
+
+def adaptive_tempo_events(times, ticks_per_quarter, tolerance, breaks=()):
+    '''
+    adaptive_tempo_events(times, ticks_per_quarter, tolerance, breaks=())
+        times - target time of every tick 0 ... end_tick (eg from target_times_from_ticks)
+        tolerance - largest timing error allowed, in seconds
+        breaks - ticks that must start an event (eg the original tempo changes)
+    RETURNS: (ticks, tempos) of tempo events (microseconds per quarter, the first at tick 0) under which every tick
+        is within tolerance of its target time. Each event holds the tempo that lands the end of its span on target
+        (so errors do not pile up from one span to the next), and spans are grown by doubling then bisecting.
+    '''
+    end_tick = len(times) - 1
+    seconds = 1e-6 / ticks_per_quarter  # seconds per tick at 1 microsecond per quarter
+    stops = np.unique(np.concatenate((np.asarray(breaks, dtype=np.int64), [end_tick])))
+
+    event_ticks, event_tempos = [], []
+    start, start_time = 0, 0.0
+    while start < end_tick:
+        limit = int(stops[np.searchsorted(stops, start, side='right')]) - start
+
+        def fit(length):
+            # the tempo for a span of length ticks from start, and the largest error on it
+            tempo = min(max(round((times[start + length] - start_time) / (length * seconds)), 1), 2**24 - 1)
+            error = np.abs(start_time + np.arange(1, length + 1) * (tempo * seconds) - times[start + 1:start + length + 1]).max()
+            return tempo, error
+
+        # a span of 1 tick is taken even if the tolerance is below what a whole microsecond tempo can hit
+        good, bad = 1, limit + 1
+        while good < bad - 1:
+            length = min(2 * good, limit) if bad == limit + 1 else (good + bad) // 2
+            if fit(length)[1] <= tolerance:
+                good = length
+            else:
+                bad = length
+
+        tempo = fit(good)[0]
+        event_ticks.append(start)
+        event_tempos.append(tempo)
+        start_time += good * tempo * seconds
+        start += good
+
+    return np.array(event_ticks, dtype=np.int64), np.array(event_tempos, dtype=np.int64)
+
+
+def assign_tempo_events(event_ticks, event_tempos, tempo_ticks):
+    '''
+    assign_tempo_events(event_ticks, event_tempos, tempo_ticks)
+    Splits adaptive tempo events between the tempo track's own tempo changes (at tempo_ticks, which should be breaks)
+    and new events at the other ticks
+    RETURNS: (new_ticks, new_tempos, varied_tempos) - varied_tempos are the tempos for the own tempo changes, in order
+    '''
+    own = np.isin(event_ticks, tempo_ticks)
+    varied_tempos = event_tempos[np.maximum(np.searchsorted(event_ticks, tempo_ticks, side='right') - 1, 0)]
+    return event_ticks[~own], event_tempos[~own], varied_tempos
+
+
+#################################################################################
+# Command line (shared by the tempo variators)
+#################################################################################
+def add_curve_arguments(parser, units, number_type=float):
+    '''
+    add_curve_arguments(parser, units, number_type=float)
+    Adds the options every tempo variator takes: -c/--curve, -cp/--curveparams, the sine's -p/--period and -a/--amplitude,
+    and where the tempo events go, -sp/--spacing or -tol/--tolerance
+        units - what positions, periods and spacings are in ("seconds" or "ticks"), number_type - their type
+    '''
+    parser.add_argument("-c", "--curve", default="sine", choices=sorted(CURVES), help="Tempo curve (see modules/tempocurves.py)")
+    parser.add_argument("-cp", "--curveparams", nargs="*", default=[], help=f"Curve parameters as name=value (lists comma separated), positions in {units}, eg period=... amplitude=1")
+    parser.add_argument("-p", "--period", type=number_type, default=None, help=f"Sine wave period in {units} (same as -cp period=...)")
+    parser.add_argument("-a", "--amplitude", type=float, default=None, help="Sine wave amplitude in octaves (same as -cp amplitude=...)")
+    parser.add_argument("-sp", "--spacing", type=number_type, default=None, help=f"Spacing between new tempo events in {units}")
+    parser.add_argument("-tol", "--tolerance", type=float, default=None, help="Instead of a fixed spacing, place tempo events only where needed to keep every tick within TOLERANCE seconds of the curve")
+
+
+def curve_params_from_args(parser, args, drawn=()):
+    '''
+    curve_params_from_args(parser, args, drawn=())
+    RETURNS: the curve parameters from the add_curve_arguments options: -cp name=value, with -p/-a filling in the sine's period and amplitude.
+        Problems go to parser.error - a bad parameter, a sine without a period and an amplitude (unless their names are in drawn,
+        parameters that are set some other way), or neither a spacing nor a tolerance
+    '''
+    try:
+        curve_params = parse_params(args.curveparams)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.period != None:
+        curve_params.setdefault("period", args.period)
+    if args.amplitude != None:
+        curve_params.setdefault("amplitude", args.amplitude)
+    if args.curve == "sine" and not {"period", "amplitude"} <= curve_params.keys() | set(drawn):
+        parser.error("the sine curve needs a period and an amplitude (-p/-a or -cp period=... amplitude=...)")
+    if args.spacing == None and args.tolerance == None:
+        parser.error("give a --spacing or a --tolerance")
+    return curve_params
+
+
+def variator_program(program, curve, curve_params, spacing, tolerance=None):
+    '''
+    RETURNS: the "Variator program" string for the variation metadata, eg "tempoVariator_time (sine) --period 5 --amplitude 1 --spacing 0.1"
+    '''
+    placement = f' --tolerance {tolerance}' if tolerance != None else f' --spacing {spacing}'
+    return f'{program} ({curve}) ' + ' '.join(f'--{k} {v}' for k, v in curve_params.items()) + placement
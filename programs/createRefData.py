@@ -1,15 +1,15 @@
 import numpy as np
 import argparse
-from music21.midi import MidiFile 
 import json
 import pickle
 
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from modules.midiscoretools import midi_to_bitmap, extract_time_signatures, count_total_ticks, Frame, loadBitmap, saveBitmap
-from modules.midiscoretools import time2tick, tick2time, ticks_per_beat_at_tick, beats_per_measure_at_tick, midi2frameskeleton
-from modules.midiscoretools import update_json_metadata
+from modules.midiscoretools import midi_to_sparse_bitmap, extract_time_signatures, count_total_ticks, Frame, FrameTable, loadBitmap, saveBitmap
+from modules.midiscoretools import time2tick, tick2time, ticks_per_beat_at_tick, beats_per_measure_at_tick, midi2frameskeleton, parse_midi
+from modules.midiscoretools import update_json_metadata, midi_to_pianoroll, savePianoroll, stream_bitmap
+from modules.midiscoretools import midi_to_sparse_bitmaps, midi2frameskeletons, frame_rate, rate_tag
 
 ###################################
 # utilities
@@ -34,79 +34,127 @@ def process_json_loc_file(input_file):
     return time_positions
 
 
+# Output name for one of several frame rates: the rate tag goes before the extension, so the name keeps
+# its format, eg frames.npy -> frames.r86.133.npy (BartokRFD1.bm -> BartokRFD1.r86.133.bm)
+def rate_output_name(fname, ratetag):
+    root, ext = os.path.splitext(fname)
+    return f"{root}.r{ratetag}{ext}"
+
+
+
+# Running sum along frames that starts over wherever restart is True:
+#     beats[f] = restart_beat[f] if restart[f] else beats[f-1] + steps[f]    (with beats[-1] = 0)
+# Each stretch between restarts becomes a row of a 2D array summed with cumsum along the row, so the additions
+# happen in the same order (and round the same way) as the frame by frame loop. Stretches are grouped by
+# length (in powers of two) so the padding never costs more than twice the number of frames.
+def _restart_accumulate(restart_beat, steps, restart) : 
+	# a restart at a virtual frame -1 with beat 0 covers the frames before the first real restart
+	restart = np.concatenate(([True], restart))
+	values = np.concatenate(([0.0], steps))
+	values[restart] = np.concatenate(([0.0], restart_beat))[restart]
+
+	starts = np.flatnonzero(restart)
+	lengths = np.diff(starts, append=len(values))
+	beats = np.empty(len(values))
+	buckets = np.ceil(np.log2(lengths)).astype(int)
+	for bucket in np.unique(buckets) :
+		rows = starts[buckets == bucket]
+		row_lengths = lengths[buckets == bucket]
+		cols = np.arange(row_lengths.max())
+		inside = cols[None,:] < row_lengths[:,None]
+		index = np.where(inside, rows[:,None] + cols[None,:], 0)
+		beats[index[inside]] = np.cumsum(np.where(inside, values[index], 0.0), axis=1)[inside]
+	return beats[1:]
+
+
+# Wraps the running beat from frame wrap (the first frame over the end of its measure) to frame end (the next restart):
+#     beats[f] = beats[f] % (bpmeasure[f] + 1) + 1 at each wrap, and beats[f-1] + steps[f] on the frames in between
+# The frames after a wrap are summed a growing window at a time up to the next wrap, so a long stretch without
+# any measurebeats costs time in proportion to its length (not its length times its number of measures).
+def _wrap_stretch(beats, steps, bpmeasure, wrap, end) :
+	while wrap < end :
+		beats[wrap] = beats[wrap] % (bpmeasure[wrap] + 1) + 1
+		start, size, wrap = wrap + 1, 64, end
+		while start < end :
+			stop = min(start + size, end)
+			run = np.cumsum(np.concatenate(([beats[start-1]], steps[start:stop])))[1:]
+			over = np.flatnonzero(run > bpmeasure[start:stop] + 1)
+			if len(over) :
+				wrap = start + over[0]
+				beats[start:wrap+1] = run[:over[0]+1]
+				break
+			beats[start:stop] = run
+			start, size = stop, 2*size
+
 
 # Here we are assigned the "place in the score" to every frame.
 # If there were no repeats, we could just count ticks and use PPQ and time signatures to compute, but
 # we need the measure information from the musicXML to get the place in the score correctly. 
 
 def measureBeats2frameList(midi_file, measurebeats, frames, verbose=False) : 
-	mf = MidiFile()
-	mf.open(midi_file)
-	mf.read()
-    
-	PPQ=mf.ticksPerQuarterNote
-	time_signatures = extract_time_signatures(midi_file)
-
-	mb_index=0
-	mb_maxindex=len(measurebeats)-1
-
-	f_index=0
-	next_f_index=1
-	f_maxindex=len(frames)-1
-
-	#used as indexes into the meaureBeats elements
-	etime=0
-	measure=1
-	beat=2
-
-	mbindex=0
-
-	previous_measure=0
-	previous_beat=0
-	previous_beat_tick=0
-
-	done = False
-
-	# Step through each frame either inserting a measure/beat from the list, or interpolating a measure/beat value
-	while not done : 
-		#  If there is a measurebeat that fits this frames time:
-		if (mbindex <= mb_maxindex) and  abs(measurebeats[mbindex][etime] - frames[f_index].mTm) <= abs(measurebeats[mbindex][etime] - frames[next_f_index].mTm) :
-			#then assign the measure and beats to the current frame
-			frames[f_index].measure = measurebeats[mbindex][measure]
-			frames[f_index].beat = measurebeats[mbindex][beat]
-
-			if verbose :
-				#print(f'assigned mb[{mbindex}] at {measurebeats[mbindex][etime]} to frame{frames[f_index]}')
-				print(f'assigned mb[{mbindex}] at {measurebeats[mbindex][etime]} to frame{frames[f_index].print_short()}')
-
-			#for computing the beat at the midpoint of the next frame
-			previous_measure=frames[f_index].measure
-			previous_beat=frames[f_index].beat  #this beat gets identified with the middle of the frame
-			previous_beat_tick=frames[f_index].mTk
-
-			#step measurebeat index
-			mbindex=mbindex+1
-            
-		else :  #interpolate the measure/beat assignment for the frame based on tick number
-			frames[f_index].measure = previous_measure
-			# add the number of ticks since last frame divided by ticks_per_beat to get portion of a beat traversed by the frame step
-			frames[f_index].beat = previous_beat + (frames[f_index].mTk-previous_beat_tick)/ticks_per_beat_at_tick(frames[f_index].mTk, time_signatures, PPQ)
-			            
-			#if the beat is in to the next measure, subtact bpmeasure
-			bpmeasure =  beats_per_measure_at_tick(frames[f_index].mTk, time_signatures)
-			if frames[f_index].beat > bpmeasure + 1 :
-			    frames[f_index].beat =  frames[f_index].beat % (bpmeasure + 1) +1
-			    
-			previous_beat=frames[f_index].beat
-			previous_beat_tick=frames[f_index].mTk
-
-		#step both frame indexes
-		f_index=f_index+1
-		next_f_index=min(next_f_index+1, f_maxindex)
-		    
-		if f_index > f_maxindex :
-			done=True
-    
+	# midi_file can be a path or an already ParsedMidi
+	# frames is the FrameTable from midi2frameskeleton (a list of Frame is converted to one); the filled in FrameTable is returned
+	parsed = parse_midi(midi_file)
+	if not isinstance(frames, FrameTable) :
+		frames = FrameTable.from_frames(frames)
+
+	nframes = len(frames)
+	mTk = frames["mTk"].astype(np.int64)
+	mTm = frames["mTm"]
+
+	# ticks-per-beat and beats-per-measure for every frame's middle tick, computed in one pass
+	time_signatures = parsed.time_signatures
+	tpb_column = time_signatures.ticks_per_beat_at(mTk)
+	bpmeasure_column = time_signatures.beats_per_measure_at(mTk)
+
+	#------ Which frame each measurebeat lands on
+	# A measurebeat goes to the first frame whose middle time is at least as close to it as the next frame's is,
+	# and frames take at most one measurebeat each, in order (so a crowded measurebeat slides to the following frame).
+	mb = np.array(measurebeats, dtype=float).reshape(-1, 3)
+	etimes, emeasures, ebeats = mb[:,0], mb[:,1], mb[:,2]
+
+	after = np.minimum(np.searchsorted(mTm, etimes, side='left'), nframes-1)
+	before = np.maximum(after-1, 0)
+	closest = np.where(np.abs(etimes - mTm[before]) <= np.abs(etimes - mTm[after]), before, after)
+	# one frame per measurebeat: the k'th goes no earlier than the frame after the (k-1)'th
+	k = np.arange(len(mb))
+	assigned = k + np.maximum.accumulate(closest - k) if len(mb) else k
+	kept = assigned <= nframes-1  # measurebeats pushed past the last frame are dropped
+	assigned, emeasures, ebeats = assigned[kept], emeasures[kept], ebeats[kept]
+
+	if verbose :
+		for mbindex, f_index in enumerate(assigned) :
+			print(f'assigned mb[{mbindex}] at {etimes[mbindex]} to frame({f_index}, mTk={mTk[f_index]}, mTm={mTm[f_index]:.3f}, measure={emeasures[mbindex]}, beat={ebeats[mbindex]})')
+
+	#------ Every other frame carries the measure of the last assigned frame, and moves its beat on by the
+	# ticks since the previous frame divided by ticks_per_beat (before the first measurebeat: measure 0, beat 0 at tick 0)
+	is_anchor = np.zeros(nframes, dtype=bool)
+	is_anchor[assigned] = True
+	anchor_measure = np.zeros(nframes)
+	anchor_beat = np.zeros(nframes)
+	anchor_measure[assigned] = emeasures
+	anchor_beat[assigned] = ebeats
+
+	last_anchor = np.maximum.accumulate(np.where(is_anchor, np.arange(nframes), -1))
+	measures = np.where(last_anchor >= 0, anchor_measure[np.maximum(last_anchor, 0)], 0)
+
+	beat_steps = np.diff(mTk, prepend=0) / tpb_column
+
+	#------ if the beat is in to the next measure, subtact bpmeasure
+	# A wrapped frame restarts the running beat just as an assigned frame does, so each stretch (between assigned
+	# frames) with a frame over the end of its measure is carried on from its first wrap by _wrap_stretch.
+	beats = _restart_accumulate(anchor_beat, beat_steps, is_anchor)
+	over = np.flatnonzero(~is_anchor & (beats > bpmeasure_column + 1))
+	if len(over) :
+		anchors = np.flatnonzero(is_anchor)
+		stretch = np.maximum.accumulate(np.where(is_anchor, np.arange(nframes), -1))
+		_, first = np.unique(stretch[over], return_index=True)
+		for wrap in over[first] :
+			next_anchor = np.searchsorted(anchors, wrap, side='right')
+			_wrap_stretch(beats, beat_steps, bpmeasure_column, wrap, anchors[next_anchor] if next_anchor < len(anchors) else nframes)
+
+	frames["measure"] = measures
+	frames["beat"] = beats
 	return frames
     
     
@@ -122,45 +170,117 @@ def main():
 	parser.add_argument("-il", "--inputlocinf", required=True, help="locinfo from Musescore plugin")
 	parser.add_argument("-ob", "--outputbitmap", required=True, help="bitmap representation of midi file")
 	parser.add_argument("-of", "--outputframes", required=True, help="Frame data for matching")
-	parser.add_argument("-r",  "--rate", type=float, required=True, help="FPS used to slice midi file (defaul 44100/512)")
+	parser.add_argument("-r",  "--rate", nargs="+", required=True, help="FPS used to slice midi file (defaul 44100/512), either as fps or sample_rate/hop_length. Several rates make one set of outputs per rate")
 	parser.add_argument("-j", "--metadata", nargs="?", default=None, help="Path to the variation metadata json")
+	parser.add_argument("-pb", "--packedbitmap", action="store_true", help="save the bitmap bit-packed in a memory-mappable .npy instead of a sparse .npz")
+	parser.add_argument("-cp", "--compactpitches", action="store_true", help="store only the band of pitches the piece uses (plus its offset) in the sparse .npz bitmap")
+	parser.add_argument("-sb", "--streamblocks", type=int, default=None, help="write the (packed) bitmap this many frames at a time instead of building it all in memory (for very long pieces)")
+	parser.add_argument("-op", "--outputpianoroll", default=None, help="(optional) onset/sustain/velocity piano roll planes of the midi file")
+	parser.add_argument("-ps", "--pianorollstack", choices=["channel", "track"], default=None, help="make the piano roll planes per channel or per track")
 
 	args = parser.parse_args()
+	# the pitch band is only stored in the sparse npz bitmap
+	if args.compactpitches and args.packedbitmap :
+		parser.error("-cp/--compactpitches only works with the sparse .npz bitmap, not with -pb/--packedbitmap")
+	if args.compactpitches and args.streamblocks != None :
+		parser.error("-cp/--compactpitches only works with the sparse .npz bitmap, not with -sb/--streamblocks")
+	# each rate also gets a tag for its output names (see rate_tag), which must not repeat
+	try :
+		rates = [frame_rate(rate) for rate in args.rate]
+	except ValueError as e :
+		parser.error(f"-r/--rate takes positive fps or sample_rate/hop_length, got {args.rate} ({e})")
+	tags = [rate_tag(rate) for rate in args.rate]
+	if len(set(tags)) < len(tags) :
+		parser.error(f"-r/--rate values {args.rate} give the same output name tag more than once ({tags})")
 	print(f'createRefData args are {args}')
 
 
-	# mf = MidiFile()
-	# mf.open(midi_file)
-	# mf.read()
+	# Read the midi file once; every stage below, at every frame rate, works from the same ParsedMidi
+	parsed = parse_midi(args.inputmidi)
+	tmb=process_json_loc_file(args.inputlocinf)
 
+	if len(rates) == 1 :
+		refDataAtRate(parsed, tmb, rates[0], args.outputbitmap, args.outputframes, args.outputpianoroll, args, args.metadata)
+	else :
+		# several resolutions: each output name gets the rate before its extension, eg BartokRFD1.r86.133.bm (or .r44100_512.bm)
+		# the notes are read once for all of the bitmaps, and the frame skeletons all come from the one tempo map
+		bitmaps = midi_to_sparse_bitmaps(parsed, rates) if args.streamblocks == None else {}
+		skeletons = midi2frameskeletons(parsed, rates)
+		resolutions = {}
+		for fps, ratetag in zip(rates, tags) :
+			outputbitmap = rate_output_name(args.outputbitmap, ratetag)
+			outputframes = rate_output_name(args.outputframes, ratetag)
+			outputpianoroll = rate_output_name(args.outputpianoroll, ratetag) if args.outputpianoroll != None else None
+			pitch_range = refDataAtRate(parsed, tmb, fps, outputbitmap, outputframes, outputpianoroll, args, None, bitmaps.get(fps), skeletons[fps])
+			resolutions[ratetag] = {
+				"fps" : fps,
+				"Midi bitmap file" : outputbitmap,
+				"Frames file" : outputframes
+			}
+			if pitch_range != None :
+				resolutions[ratetag]["Midi bitmap pitch range"] = pitch_range
+			if outputpianoroll != None :
+				resolutions[ratetag]["Midi pianoroll file"] = outputpianoroll
+		if (args.metadata != None) : 
+			update_json_metadata(args.metadata, {
+				"Resolutions" : resolutions,
+		        "Midi bitmap orientation": "time along rows",
+		        "Midi bitmap format": "packed bits (npy)" if (args.packedbitmap or args.streamblocks != None) else "sparse (npz)"
+		    })
+
+
+# Bitmap, optional piano roll, and reference frames for one frame rate (the bitmap and the frame skeleton may be passed in already made)
+# Returns the [min, max] pitch range stored with -cp (None without it)
+def refDataAtRate(parsed, tmb, fps, outputbitmap, outputframes, outputpianoroll, args, metadata, premade=None, skeleton=None) :
 	# First make the bitmap "score" input for the NN
-	bitmap, _, _ = midi_to_bitmap(args.inputmidi, args.rate) 
+	pitch_range = None
+	if args.streamblocks != None :
+		# written block by block straight to the packed npy (or an .h5 if that is the output name), never all in memory
+		stream_bitmap(parsed, outputbitmap, fps, block_frames=args.streamblocks)
+	else :
+		bitmap, minpitch, maxpitch = premade if premade != None else midi_to_sparse_bitmap(parsed, fps) 
+
+		###############################################
+		# Save the matrix to a binary file in .npy format
+		#np.save(args.outputbitmap, bitmap) # adds an npy extension to the save file 
+		pitch_range = [int(minpitch), int(maxpitch)] if args.compactpitches else None
+		saveBitmap(outputbitmap,bitmap.T, packed=args.packedbitmap, pitch_range=pitch_range)  #this saves as (sparse) npz, WAY smaller file size! (or packed bits in npy)
+	if (metadata != None) : 
+		update_json_metadata(metadata, {
+			"Midi bitmap file" : outputbitmap,
+	        "Midi bitmap orientation": "time along rows",
+	        "Midi bitmap format": "packed bits (npy)" if (args.packedbitmap or args.streamblocks != None) else "sparse (npz)"
+	    })
+		if pitch_range != None :
+			update_json_metadata(metadata, {"Midi bitmap pitch range" : pitch_range})
 
 	###############################################
-	# Save the matrix to a binary file in .npy format
-	#np.save(args.outputbitmap, bitmap) # adds an npy extension to the save file 
-	saveBitmap(args.outputbitmap,bitmap.T )  #this saves as npz, WAY smaller file size!
-	if (args.metadata != None) : 
-		update_json_metadata(args.metadata, {
-			"Midi bitmap file" : args.outputbitmap,
-	        "Midi bitmap orientation": "time along rows"
-	    })
+	# Optionally, the onset/sustain/velocity planes from the same parse
+	if outputpianoroll != None :
+		roll, planes = midi_to_pianoroll(parsed, fps, stack_by=args.pianorollstack)
+		savePianoroll(outputpianoroll, roll, planes)
+		if (metadata != None) : 
+			update_json_metadata(metadata, {
+				"Midi pianoroll file" : outputpianoroll,
+				"Midi pianoroll planes" : planes,
+		        "Midi pianoroll orientation": "time along rows"
+		    })
 
 	###############################################
 
 
 	# Now create the "reference frame list" from frame to musical measure and beat
-	tmb=process_json_loc_file(args.inputlocinf)
-	emptyFrameList=midi2frameskeleton(args.inputmidi,args.rate)
+	emptyFrameList=skeleton if skeleton is not None else midi2frameskeleton(parsed,fps)
 	#------ fill it in with measure and beat info
-	refFrameList=measureBeats2frameList(args.inputmidi, tmb, emptyFrameList)
-	Frame.save_frames(refFrameList, args.outputframes)
+	refFrameList=measureBeats2frameList(parsed, tmb, emptyFrameList)
+	Frame.save_frames(refFrameList, outputframes)
 	# # write foo to file
 	# with open(args.outputframes + '.pkl', 'wb') as f:
 	# 	pickle.dump(refFrameList, f)
 
 
-	print(f"Processed MIDI file saved as {args.outputbitmap} and {args.outputframes}")
+	print(f"Processed MIDI file saved as {outputbitmap} and {outputframes}")
+	return pitch_range
 
 if __name__ == "__main__":
 	main()
@@ -1,35 +1,60 @@
 import argparse
 import numpy as np
-from bisect import bisect_left
 
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from modules.midiscoretools import Frame, update_json_metadata, addExtensionIfNeeded
-
-
-def find_closest_frame(f1_frames, f2_frame):
-    mTk_values = [f.mTk for f in f1_frames]
-    idx = bisect_left(mTk_values, f2_frame.mTk)
-    if idx == 0:
-        return f1_frames[0]
-    if idx == len(f1_frames):
-        return f1_frames[-1]
-    before = f1_frames[idx-1]
-    after = f1_frames[idx]
-    if after.mTk - f2_frame.mTk < f2_frame.mTk - before.mTk:
-        return after
-    else:
-        return before
+from modules.midiscoretools import Frame, FrameTable, update_json_metadata, addExtensionIfNeeded
+
+
+def find_closest_frames(f1_mTk, f2_mTk):
+    '''
+    For each f2 middle tick, the index of the f1 frame with the closest middle tick (f1_mTk sorted).
+    On a tie the earlier f1 frame wins; ticks before the first or after the last f1 frame go to that end frame.
+    '''
+    f1_mTk = np.asarray(f1_mTk)
+    f2_mTk = np.asarray(f2_mTk)
+    idx = np.searchsorted(f1_mTk, f2_mTk, side='left')
+    after = np.minimum(idx, len(f1_mTk)-1)
+    before = np.maximum(idx-1, 0)
+    closest = np.where(f1_mTk[after] - f2_mTk < f2_mTk - f1_mTk[before], after, before)
+    # the ends have only one neighbour
+    closest[idx == 0] = 0
+    closest[idx == len(f1_mTk)] = len(f1_mTk)-1
+    return closest
 
 def process_frames(f1_frames, f2_frames):
-    for f2 in f2_frames:
-        closest_f1 = find_closest_frame(f1_frames, f2)
-        f2.beat = closest_f1.beat
-        f2.measure = closest_f1.measure
-        f2.refframe = closest_f1.num
+    # FrameTables (lists of Frame are converted); the f2 table is filled in and returned
+    if not isinstance(f1_frames, FrameTable):
+        f1_frames = FrameTable.from_frames(f1_frames)
+    if not isinstance(f2_frames, FrameTable):
+        f2_frames = FrameTable.from_frames(f2_frames)
+
+    closest_f1 = find_closest_frames(f1_frames["mTk"], f2_frames["mTk"])
+    f2_frames["beat"] = f1_frames["beat"][closest_f1]
+    f2_frames["measure"] = f1_frames["measure"][closest_f1]
+    f2_frames["refframe"] = f1_frames["num"][closest_f1]
     return f2_frames
 
+def match_variant(f1_frames, file2, output, gtoutput, metadata=None):
+    # match one variant's frame file against the (already loaded) reference frames, and write its outputs
+    f2_frames = FrameTable.load(file2)
+
+    updated_f2_frames = process_frames(f1_frames, f2_frames)
+    Frame.save_frames(updated_f2_frames, output)
+
+    # now save the ground truth vector
+    gt = updated_f2_frames["refframe"].astype(np.int64)
+    np.savez(addExtensionIfNeeded(gtoutput, ext="npz"), gt)
+
+    if (metadata != None) : 
+        update_json_metadata(metadata, {
+            "gt output file": gtoutput
+        })
+
+
+    print(f"Processed frames saved to {output}")
+
 def main():
     parser = argparse.ArgumentParser(description="Process two frame files and output matched frames.")
     parser.add_argument("file1", help="Path to the first input file (f1)")
@@ -42,23 +67,8 @@ def main():
 
     args = parser.parse_args()
 
-    f1_frames = Frame.load_frames(args.file1)
-    f2_frames = Frame.load_frames(args.file2)
-
-    updated_f2_frames = process_frames(f1_frames, f2_frames)
-    Frame.save_frames(updated_f2_frames, args.output)
-
-    # now save the ground truth vector
-    gt = np.array([x.refframe for x in updated_f2_frames])
-    np.savez(addExtensionIfNeeded(args.gtoutput, ext="npz"), gt)
-
-    if (args.metadata != None) : 
-        update_json_metadata(args.metadata, {
-            "gt output file": args.gtoutput
-        })
-
-
-    print(f"Processed frames saved to {args.output}")
+    f1_frames = FrameTable.load(args.file1)
+    match_variant(f1_frames, args.file2, args.output, args.gtoutput, args.metadata)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,87 @@
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.midiscoretools import FrameTable
+from frameMatch import match_variant
+
+###################################
+# Batch version of frameMatch.py: one reference frame file against many variant frame files.
+# The reference is loaded once (once per worker with -p), and for every variant X.frames(.npz) this writes
+#     X.framesout, X.gt                          (next to the variant's frames)
+# and records the gt file in the variant's metadata json (--metadata, looked up in the variant's folder).
+###################################
+
+
+def variant_outputs(file2):
+    # BartokRFD1.v001.frames(.npz) -> (BartokRFD1.v001.framesout, BartokRFD1.v001.gt)
+    stem = os.path.splitext(file2)[0] if file2.endswith(('.npz', '.npy')) else file2
+    stem = stem[:-len('.frames')] if stem.endswith('.frames') else stem
+    return stem + '.framesout', stem + '.gt'
+
+
+def expand_variants(patterns):
+    # files and glob patterns, in a stable (sorted) order, without duplicates
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        files.extend(f for f in matches if f not in files)
+    return files
+
+
+# each worker process keeps its own copy of the reference frames
+_reference = None
+
+def _init_worker(reference_file):
+    global _reference
+    _reference = FrameTable.load(reference_file, mmap=False)
+
+def _match_one(job):
+    match_variant(_reference, *job)
+    return job[0]
+
+
+def match_batch(reference_file, variant_files, metadata_name=None, processes=None):
+    '''
+    match_batch(reference_file, variant_files, metadata_name=None, processes=None)
+        variant_files - list of variant frame files
+        metadata_name - name of the metadata json in each variant's folder to update (eg BartokRFD1.metadata.jsn)
+        processes - number of worker processes (None or 1: match them all in this process)
+    RETURNS: the list of variant files matched
+    '''
+    jobs = []
+    for file2 in variant_files:
+        output, gtoutput = variant_outputs(file2)
+        metadata = os.path.join(os.path.dirname(file2), metadata_name) if metadata_name != None else None
+        jobs.append((file2, output, gtoutput, metadata))
+
+    if processes == None or processes <= 1:
+        _init_worker(reference_file)
+        return [_match_one(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(reference_file,)) as pool:
+        return list(pool.map(_match_one, jobs, chunksize=max(1, len(jobs) // (4*processes))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match many variant frame files against one reference frame file.")
+    parser.add_argument("reference", help="Path to the reference frames file (f1)")
+    parser.add_argument("variants", nargs="+", help="Variant frame files (f2), or glob patterns for them (quote them)")
+    parser.add_argument("-j", "--metadata", default=None, help="Name of the metadata json in each variant's folder to update (eg BartokRFD1.metadata.jsn)")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="Number of worker processes")
+
+    args = parser.parse_args()
+
+    variant_files = expand_variants(args.variants)
+    if not variant_files:
+        print("No variant frame files found")
+        sys.exit(1)
+
+    matched = match_batch(args.reference, variant_files, args.metadata, args.processes)
+    print(f"Matched {len(matched)} variants against {args.reference}")
+
+if __name__ == "__main__":
+    main()
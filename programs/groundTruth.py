@@ -0,0 +1,39 @@
+import argparse
+import numpy as np
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.midiscoretools import groundtruth_from_tempo_maps, frame_rate, update_json_metadata, addExtensionIfNeeded
+
+# Ground truth for a tempo variant straight from the two tempo maps, instead of
+# building frame lists for both files (createRefData, melFrames) and matching them (frameMatch).
+# Only valid for variants whose ticks are the reference's ticks (tempoVariator_time, tempoVariator_ticks).
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the ground truth refframe vector of a tempo variant from the tempo maps.")
+    parser.add_argument("refmidi", help="Path to the reference midi file")
+    parser.add_argument("varmidi", help="Path to the tempo variant midi file")
+    parser.add_argument("gtoutput", help="Path to the ground truth refframe list output file")
+    parser.add_argument("-rr", "--refrate", type=frame_rate, required=True, help="FPS of the reference frames (fps or sample_rate/hop_length)")
+    parser.add_argument("-rv", "--varrate", type=frame_rate, default=None, help="FPS of the variant frames (default: the reference rate)")
+    parser.add_argument("-j", "--metadata", nargs="?", default=None, help="Path to the variation metadata json")
+
+    args = parser.parse_args()
+    varrate = args.varrate if args.varrate != None else args.refrate
+
+    gt, gt_frac = groundtruth_from_tempo_maps(args.refmidi, args.varmidi, args.refrate, varrate)
+
+    # arr_0 is the integer refframe vector, as frameMatch writes it; refframe_frac the exact position
+    np.savez(addExtensionIfNeeded(args.gtoutput, ext="npz"), gt, refframe_frac=gt_frac)
+
+    if (args.metadata != None) : 
+        update_json_metadata(args.metadata, {
+            "gt output file": args.gtoutput,
+            "gt method": f"groundTruth (tempo maps) --refrate {args.refrate} --varrate {varrate}"
+        })
+
+    print(f"Ground truth for {len(gt)} frames saved to {args.gtoutput}")
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,6 @@ import soundfile as sf
 import numpy as np
 import argparse
 
-import librosa
-
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -67,6 +65,9 @@ def main():
 		# Apply to your audio data
 		wave_data = mono_wave_data.astype(np.float32)
 
+		# librosa is slow to import, so only pay for it once we get here
+		import librosa
+
 		if original_sample_rate != sample_rate:
 			wave_data = librosa.resample(wave_data, orig_sr=original_sample_rate, target_sr=sample_rate)
 
@@ -6,7 +6,7 @@ import json
 import os
 from datetime import datetime
 
-def create_optimized_hdf5(output_path, matrix1, matrix2, gtvector, metadata, chunk_size=100):
+def create_optimized_hdf5(output_path, matrix1, matrix2, gtvector, metadata, chunk_size=100, pianoroll=None, packed=False, pitch_offset=0, compact=False):
     """
     Create an HDF5 file with optimized chunking and indexing.
     
@@ -16,18 +16,42 @@ def create_optimized_hdf5(output_path, matrix1, matrix2, gtvector, metadata, chu
     :param gtvector: Ground truth vector numpy array
     :param metadata: Dictionary containing metadata
     :param chunk_size: Size of chunks for storage and access
+    :param pianoroll: Optional dict of plane name to uint8 (frames, 128) array, stored as extra datasets under pianoroll/
+    :param packed: Store matrix1 (a 0/1 bitmap) as np.packbits rows, uncompressed, so slices need no decompression
+    :param pitch_offset: Pitch of matrix1's first column (non-zero for a bitmap saved with a compact pitch range)
+    :param compact: Store only the band of matrix1 columns that have any notes, recording its first pitch in matrix1_pitch_offset
     """
     # Convert matrix1 to dense if it's sparse
     if sparse.issparse(matrix1):
         matrix1 = matrix1.toarray()
+
+    if compact:
+        used = np.flatnonzero(matrix1.any(axis=0))
+        low, high = (used[0], used[-1]) if len(used) else (0, -1)
+        matrix1 = matrix1[:, low:high + 1]
+        pitch_offset += int(low)
+
+    matrix1_width = matrix1.shape[1]
+    if packed:
+        matrix1 = np.packbits(matrix1 != 0, axis=1)
     
     total_samples = len(gtvector)
     
     with h5py.File(output_path, 'w') as hf:
         # Store matrices and vector with chunking
-        hf.create_dataset('matrix1', data=matrix1, chunks=(chunk_size, matrix1.shape[1]), compression="gzip", compression_opts=9)
+        if packed:
+            # 16 bytes per frame already; leaving it uncompressed means reading a window is just a copy
+            hf.create_dataset('matrix1', data=matrix1, chunks=(chunk_size, matrix1.shape[1]))
+        else:
+            hf.create_dataset('matrix1', data=matrix1, chunks=(chunk_size, matrix1.shape[1]), compression="gzip", compression_opts=9)
         hf.create_dataset('matrix2', data=matrix2, chunks=(chunk_size, matrix2.shape[1]), compression="gzip", compression_opts=9)
         hf.create_dataset('gtvector', data=gtvector, chunks=(chunk_size,), compression="gzip", compression_opts=9)
+
+        # Optional piano roll planes (onset, sustain, velocity, ...), chunked the same way as matrix1
+        if pianoroll:
+            for name, plane in pianoroll.items():
+                hf.create_dataset(f'pianoroll/{name}', data=plane, chunks=(chunk_size, plane.shape[1]), compression="gzip", compression_opts=9)
+            hf.attrs['pianoroll_planes'] = json.dumps(list(pianoroll.keys()))
         
         # Create index dataset
         num_chunks = (total_samples + chunk_size - 1) // chunk_size
@@ -40,7 +64,9 @@ def create_optimized_hdf5(output_path, matrix1, matrix2, gtvector, metadata, chu
         # Add helpful attributes
         hf.attrs['total_samples'] = total_samples
         hf.attrs['chunk_size'] = chunk_size
-        hf.attrs['matrix1_shape'] = matrix1.shape
+        hf.attrs['matrix1_shape'] = (matrix1.shape[0], matrix1_width)
+        hf.attrs['matrix1_packed'] = packed
+        hf.attrs['matrix1_pitch_offset'] = pitch_offset
         hf.attrs['matrix2_shape'] = matrix2.shape
         
         # Store dtype information
@@ -53,19 +79,38 @@ def create_optimized_hdf5(output_path, matrix1, matrix2, gtvector, metadata, chu
 def main():
     parser = argparse.ArgumentParser(description='Create optimized HDF5 file from numpy arrays with metadata from JSON.')
     parser.add_argument('-o', '--output', required=True, help='Output HDF5 file path')
-    parser.add_argument('-m1', '--matrix1', required=True, help='Path to first matrix .npz file')
+    parser.add_argument('-m1', '--matrix1', required=True, help='Path to first matrix .npz file (or a bit-packed .npy bitmap, or an .h5 bitmap written by stream_bitmap)')
     parser.add_argument('-m2', '--matrix2', required=True, help='Path to second matrix .npz file')
     parser.add_argument('-v', '--gtvector', required=True, help='Path to teaching gtvector .npz file')
 #    parser.add_argument('-j', '--json-metadata', required=True, help='Path to JSON file containing metadata')
     parser.add_argument("-j", "--metadata", nargs="?", default=None, help="Path to the variation metadata json")
     parser.add_argument('-c', '--chunk-size', type=int, default=100, help='Chunk size for HDF5 storage')
+    parser.add_argument('-p', '--packed', action='store_true', help='Store matrix1 bit-packed (uncompressed) instead of gzipped')
+    parser.add_argument('-cp', '--compact', action='store_true', help='Store only the band of matrix1 pitches that are used (the data loaders re-expand it to 128)')
+    parser.add_argument('-pr', '--pianoroll', default=None, help='(optional) Path to a piano roll .npz file written by createRefData -op')
 
     args = parser.parse_args()
 
     # Load numpy arrays
-    matrix1 = sparse.load_npz(args.matrix1)  # Assuming the array is stored with scipy.sparse.save_npz
+    pitch_offset = 0
+    if args.matrix1.endswith('.npy'):
+        matrix1 = np.unpackbits(np.load(args.matrix1), axis=1)  # bit-packed bitmap, as stored with saveBitmap(..., packed=True)
+    elif args.matrix1.lower().endswith(('.h5', '.hdf5')):
+        with h5py.File(args.matrix1, 'r') as hf:  # streamed with stream_bitmap: a matrix1 dataset, bit-packed unless its matrix1_packed attr says not
+            matrix1 = hf['matrix1'][:]
+            if hf.attrs.get('matrix1_packed', True):
+                matrix1 = np.unpackbits(matrix1, axis=1)
+    else:
+        matrix1 = sparse.load_npz(args.matrix1)  # Assuming the array is stored with scipy.sparse.save_npz
+        with np.load(args.matrix1) as loaded:  # saveBitmap(..., pitch_range=...) stores just a band of pitches starting at pitch_offset
+            if 'pitch_offset' in loaded.files:
+                pitch_offset = int(loaded['pitch_offset'])
     matrix2 = np.load(args.matrix2)['arr_0'] # Assuming the array is stored with np.savez
     gtvector = np.load(args.gtvector)['arr_0']  # Assuming the array is stored with np.savez
+    pianoroll = None
+    if args.pianoroll is not None:
+        with np.load(args.pianoroll) as loaded:  # one (frames, 128) uint8 array per plane, stored with np.savez_compressed
+            pianoroll = {name: loaded[name] for name in loaded.files}
 
 
     # Load metadata from JSON file
@@ -83,7 +128,7 @@ def main():
             print(f"{key}: {type(value)}")
 
 
-    create_optimized_hdf5(args.output, matrix1, matrix2, gtvector, metadata, chunk_size=args.chunk_size)
+    create_optimized_hdf5(args.output, matrix1, matrix2, gtvector, metadata, chunk_size=args.chunk_size, pianoroll=pianoroll, packed=args.packed, pitch_offset=pitch_offset, compact=args.compact)
 
     print(f"Optimized HDF5 file created successfully: {args.output}")
 
@@ -101,6 +146,8 @@ def main():
 
     # Compare file sizes
     original_size = os.path.getsize(args.matrix1) + os.path.getsize(args.matrix2) + os.path.getsize(args.gtvector)
+    if args.pianoroll is not None:
+        original_size += os.path.getsize(args.pianoroll)
     new_size = os.path.getsize(args.output)
     print(f"\nOriginal total size: {original_size / 1024 / 1024:.2f} MB")
     print(f"New HDF5 file size: {new_size / 1024 / 1024:.2f} MB")
@@ -0,0 +1,137 @@
+import argparse
+import inspect
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.midiscoretools import update_json_metadata, parse_midi
+from modules.smfwriter import write_with_track
+from modules.tempocurves import CURVES, describe, variator_program, add_curve_arguments, curve_params_from_args
+from tempoVariator_time import find_last_event_tick, vary_tempo_track
+
+###################################
+# Batch version of tempoVariator_time.py: N tempo variants of one reference midi file.
+# The reference is parsed once (and handed once to each worker with -np); only track 0 is encoded per variant,
+# the note tracks are copied byte for byte from the reference. For variant tag T (v001, v002, ...) of score S this writes
+#     OUTDIR/T/S.T.mid, and updates OUTDIR/T/S.metadata.jsn
+# Curve parameters given as ranges (-cr name=lo:hi) are drawn uniformly for each variant, from a generator seeded
+# by (--seed, variant number), so a variant is the same whatever the batch size or number of processes.
+###################################
+
+
+def variant_paths(midi_file, outdir, tag):
+    # scores/Bartok/RefData/BartokRFD1.mid, VarData, v001 -> (VarData/v001/BartokRFD1.v001.mid, VarData/v001/BartokRFD1.metadata.jsn)
+    score = os.path.splitext(os.path.basename(midi_file))[0]
+    folder = os.path.join(outdir, tag)
+    return os.path.join(folder, f'{score}.{tag}.mid'), os.path.join(folder, f'{score}.metadata.jsn')
+
+
+def parse_ranges(items):
+    '''
+    parse_ranges(["amplitude=.5:1.5"]) -> {"amplitude": (0.5, 1.5)}
+    '''
+    ranges = {}
+    for item in items or []:
+        key, sep, value = item.partition('=')
+        lo, colon, hi = value.partition(':')
+        if not sep or not colon:
+            raise ValueError(f"Curve parameter range '{item}' is not of the form name=lo:hi")
+        ranges[key] = (float(lo), float(hi))
+    return ranges
+
+
+def variant_params(curve, curve_params, ranges, seed, number):
+    '''
+    RETURNS: the curve parameters of variant number - curve_params, plus a uniform draw for each of ranges,
+        plus (for curves that take one, eg smooth_random) a seed of its own if curve_params does not fix it
+    '''
+    rng = np.random.default_rng([seed, number])
+    params = dict(curve_params)
+    for key, (lo, hi) in ranges.items():
+        params[key] = float(rng.uniform(lo, hi))
+    if "seed" in inspect.signature(CURVES[curve]).parameters and "seed" not in params:
+        params["seed"] = int(rng.integers(2**31))
+    return params
+
+
+# each worker process keeps its own copy of the parsed reference
+_reference = None
+
+def _init_worker(smf):
+    global _reference
+    _reference = (smf, find_last_event_tick(smf))
+
+def _vary_one(job):
+    output, metadata, spacing, tolerance, curve, params, seed = job
+    smf, last_event_tick = _reference
+
+    tempo_track = vary_tempo_track(smf, spacing, curve, params, last_event_tick, tolerance)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    write_with_track(smf, output, 0, tempo_track)
+
+    if metadata != None:
+        update_json_metadata(metadata, {
+            "Variator program" : variator_program('tempoVariator_time', curve, params, spacing, tolerance),
+            "Tempo curve" : describe(curve, params),
+            "Variant seed" : seed,
+        })
+    return output
+
+
+def vary_batch(midi_file, outdir, count, spacing, curve="sine", curve_params=None, ranges=None, seed=0, first=1, tag_format="v{:03d}", metadata=True, processes=None, tolerance=None):
+    '''
+    vary_batch(midi_file, outdir, count, spacing, curve="sine", curve_params=None, ranges=None, seed=0, first=1, tag_format="v{:03d}", metadata=True, processes=None, tolerance=None)
+        count - number of variants, numbered first, first+1, ... and tagged with tag_format
+        spacing, tolerance - tempo event spacing in seconds, or (if tolerance is given) adaptive placement to within tolerance seconds
+        curve_params - fixed curve parameters, ranges - {name: (lo, hi)} drawn for each variant
+        metadata - update each variant's metadata json
+        processes - number of worker processes (None or 1: make them all in this process)
+    RETURNS: the list of variant midi files written
+    '''
+    smf = parse_midi(midi_file).smf
+
+    jobs = []
+    for number in range(first, first + count):
+        output, metadata_file = variant_paths(midi_file, outdir, tag_format.format(number))
+        params = variant_params(curve, curve_params or {}, ranges or {}, seed, number)
+        jobs.append((output, metadata_file if metadata else None, spacing, tolerance, curve, params, [seed, number]))
+
+    if processes == None or processes <= 1:
+        _init_worker(smf)
+        return [_vary_one(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(smf,)) as pool:
+        return list(pool.map(_vary_one, jobs, chunksize=max(1, len(jobs) // (4*processes))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Make many tempo variants of one MIDI file (see tempoVariator_time.py)")
+    parser.add_argument("-m", "--midi", required=True, help="Input MIDI file")
+    parser.add_argument("-o", "--outdir", required=True, help="Folder for the variant folders (eg scores/BartokRFD1/VarData)")
+    parser.add_argument("-n", "--count", type=int, required=True, help="Number of variants")
+    parser.add_argument("-f", "--first", type=int, default=1, help="Number of the first variant")
+    parser.add_argument("-t", "--tag", default="v{:03d}", help="Format of the variant tags (folder and file name)")
+    # the same curve options as tempoVariator_time.py (so its -p/-a for the sine work here too)
+    add_curve_arguments(parser, "seconds")
+    parser.add_argument("-cr", "--curveranges", nargs="*", default=[], help="Curve parameters drawn for each variant, as name=lo:hi")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Seed for the variant parameter draws")
+    parser.add_argument("-nj", "--nometadata", action="store_true", help="Do not write the variant metadata json files")
+    parser.add_argument("-np", "--processes", type=int, default=1, help="Number of worker processes")
+
+    args = parser.parse_args()
+
+    try:
+        ranges = parse_ranges(args.curveranges)
+    except ValueError as e:
+        parser.error(str(e))
+    curve_params = curve_params_from_args(parser, args, drawn=ranges.keys())
+
+    outputs = vary_batch(args.midi, args.outdir, args.count, args.spacing, args.curve, curve_params, ranges,
+                         args.seed, args.first, args.tag, not args.nometadata, args.processes, args.tolerance)
+    print(f"Wrote {len(outputs)} variants of {args.midi} to {args.outdir}")
+
+if __name__ == "__main__":
+    main()
@@ -1,129 +1,78 @@
-import mido
-import math
 import argparse
+import numpy as np
 
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from modules.midiscoretools import update_json_metadata
-
-def sine_wave(period, amplitude, tick):
-    frequency = 2 * math.pi / period
-    sine_value = math.sin(frequency * tick)
-    return 2 ** (sine_value * amplitude)
-
-def find_true_end_tick(midi_file):
-    end_tick = 0
-    for track in midi_file.tracks:
-        track_ticks = sum(msg.time for msg in track)
-        end_tick = max(end_tick, track_ticks)
-    return end_tick
-
-def process_midi_file(input_file, period, amplitude, spacing):
-    mid = mido.MidiFile(input_file)
-    output_mid = mido.MidiFile(type=mid.type, ticks_per_beat=mid.ticks_per_beat)
-
-    tempo_track = mido.MidiTrack()
-    output_mid.tracks.append(tempo_track)
-
-    current_tempo = 500000  # Default tempo (120 BPM)
-    last_tempo_change_tick = 0
-    cumulative_tick = 0
-    
-    # Find the true end tick of the original file
-    true_end_tick = find_true_end_tick(mid)
-
-    # First pass: collect all tempo changes
-    tempo_changes = []
-    for msg in mid.tracks[0]:
-        cumulative_tick += msg.time
-        if msg.type == 'set_tempo':
-            tempo_changes.append((cumulative_tick, msg.tempo))
-    
-    if tempo_changes:
-        current_tempo = tempo_changes[0][1]  # Use the first tempo if available
-
-    cumulative_tick = 0
-    last_original_tempo_index = -1
-
-    # Second pass: process tempo track
-    for msg in mid.tracks[0]:
-        delta_ticks = msg.time
-        cumulative_tick += delta_ticks
-
-        # Add new tempo events at specified intervals, update the following event delta ticks
-        while last_tempo_change_tick + spacing <= cumulative_tick:
-            new_tempo_tick = last_tempo_change_tick + spacing
-            factor = sine_wave(period, amplitude, new_tempo_tick)
-            
-            # Find the current original tempo
-            while last_original_tempo_index + 1 < len(tempo_changes) and tempo_changes[last_original_tempo_index + 1][0] <= new_tempo_tick:
-                last_original_tempo_index += 1
-            original_tempo = tempo_changes[last_original_tempo_index][1] if last_original_tempo_index >= 0 else current_tempo
-            
-            new_tempo = int(original_tempo / factor)
-            new_delta_ticks = new_tempo_tick - last_tempo_change_tick
-            
-            new_tempo_msg = mido.MetaMessage('set_tempo', tempo=new_tempo, time=new_delta_ticks)
-            tempo_track.append(new_tempo_msg)
-            
-            last_tempo_change_tick = new_tempo_tick
-
-        # Adjust the delta ticks of the original message
-        adjusted_delta_ticks = cumulative_tick - last_tempo_change_tick
-        
-        if msg.type == 'set_tempo':
-            factor = sine_wave(period, amplitude, cumulative_tick)
-            new_tempo = int(msg.tempo / factor)
-            new_msg = mido.MetaMessage('set_tempo', tempo=new_tempo, time=adjusted_delta_ticks)
-        else:
-            new_msg = msg.copy(time=adjusted_delta_ticks)
-        
-        tempo_track.append(new_msg)
-        last_tempo_change_tick = cumulative_tick
-
-    # Ensure the tempo track extends to the true end of the file
-    if cumulative_tick < true_end_tick:
-        remaining_ticks = true_end_tick - cumulative_tick
-        tempo_track.append(mido.MetaMessage('text', text='File end padding', time=remaining_ticks))
-
-    # Process other tracks (no changes necessary since delta ticks don't change with BPM!)
-    for track in mid.tracks[1:]:
-        new_track = mido.MidiTrack()
-        output_mid.tracks.append(new_track)
-        for msg in track:
-            new_track.append(msg.copy())
-
-    # Add end of track message to all tracks
-    for track in output_mid.tracks:
-        if not track or track[-1].type != 'end_of_track':
-            end_of_track = mido.MetaMessage('end_of_track', time=0)
-            track.append(end_of_track)
-
-    return output_mid
+from modules import smfreader
+from modules.midiscoretools import update_json_metadata, parse_midi, getNumber
+from modules.smfwriter import rewrite_tempo_track, write_with_track
+from modules.tempocurves import tempo_factors, describe, target_times_from_ticks, adaptive_tempo_events, assign_tempo_events
+from modules.tempocurves import add_curve_arguments, curve_params_from_args, variator_program
+
+def insertion_ticks(message_ticks, spacing):
+    """
+    The ticks where new tempo events go: every spacing ticks after each message of the tempo track,
+    up to (and including) the next message
+    """
+    message_ticks = np.asarray(message_ticks, dtype=np.int64)
+    previous = np.concatenate(([0], message_ticks[:-1]))
+    counts = (message_ticks - previous) // spacing
+    first = np.cumsum(counts) - counts
+    steps = np.arange(counts.sum()) - np.repeat(first, counts) + 1
+    return np.repeat(previous, counts) + spacing * steps
+
+def process_midi_file(input_file, output_file, spacing, curve="sine", curve_params=None, tolerance=None):
+    # curve and curve_params choose the tempo curve (see modules/tempocurves.py), evaluated at positions in ticks
+    # with a tolerance (seconds), tempo events go only where they are needed to keep every tick that close to the curve, and spacing is not used
+    curve_params = curve_params or {}
+    smf = parse_midi(input_file).smf
+    track0 = smf.tracks[0]
+    message_ticks = track0["abs_tick"]
+
+    # The original tempo changes of track 0 (until the first one, the tempo is the first one, or 120 BPM without any)
+    is_tempo = (track0["type"] == smfreader.META) & (track0["meta_type"] == smfreader.SET_TEMPO)
+    tempo_ticks = message_ticks[is_tempo]
+    tempos = np.array([getNumber(smf.payload(event), 3) for event in track0[is_tempo]], dtype=np.int64)
+    current_tempo = tempos[0] if len(tempos) else 500000  # Default tempo (120 BPM)
+
+    if tolerance != None:
+        # Adaptive tempo events (the original tempo changes start events of their own)
+        times = target_times_from_ticks(curve, max(smf.end_ticks()), tempo_ticks, tempos, smf.ticks_per_quarter, **curve_params)
+        event_ticks, event_tempos = adaptive_tempo_events(times, smf.ticks_per_quarter, tolerance, breaks=tempo_ticks)
+        new_tempo_ticks, new_tempos, varied_tempos = assign_tempo_events(event_ticks, event_tempos, tempo_ticks)
+    else:
+        # New tempo events every spacing ticks after each message, at the original tempo there divided by the curve
+        new_tempo_ticks = insertion_ticks(message_ticks, spacing)
+        original_tempos = np.concatenate(([current_tempo], tempos))[np.searchsorted(tempo_ticks, new_tempo_ticks, side='right')]
+        new_tempos = (original_tempos / tempo_factors(curve, new_tempo_ticks, **curve_params)).astype(np.int64)
+        # the original tempo changes are varied too
+        varied_tempos = (tempos / tempo_factors(curve, tempo_ticks, **curve_params)).astype(np.int64)
+
+    # the tempo track extends to the true end of the file
+    tempo_track = rewrite_tempo_track(smf, new_tempo_ticks, new_tempos, varied_tempos, pad_to=max(smf.end_ticks()), pad_text='File end padding')
+
+    # The other tracks are copied byte for byte (no changes necessary since delta ticks don't change with BPM!)
+    write_with_track(smf, output_file, 0, tempo_track)
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Vary tempo of a MIDI file using a sine wave")
+    parser = argparse.ArgumentParser(description="Vary tempo of a MIDI file using a tempo curve (a sine wave by default)")
     parser.add_argument("-m", "--midi", required=True, help="Input MIDI file")
     parser.add_argument("-om", "--output", required=True, help="Output MIDI file")
-    parser.add_argument("-p", "--period", type=int, required=True, help="Sine wave period in ticks")
-    parser.add_argument("-a", "--amplitude", type=float, required=True, help="Sine wave amplitude in octaves")
-    parser.add_argument("-sp", "--spacing", type=int, required=True, help="Spacing between new tempo events in ticks")
+    add_curve_arguments(parser, "ticks", number_type=int)
     parser.add_argument("-j", "--metadata", nargs="?", default=None, help="Path to the variation metadata json")
     
     args = parser.parse_args()
 
-    output_mid=process_midi_file(args.midi, args.period, args.amplitude, args.spacing)
+    curve_params = curve_params_from_args(parser, args)
+    process_midi_file(args.midi, args.output, args.spacing, args.curve, curve_params, args.tolerance)
     print(f"Processed MIDI file saved as {args.output}")
 
-
-
-    output_mid.save(args.output)
-
     if (args.metadata != None) : 
         update_json_metadata(args.metadata, {
-            "Variator program" : f'tempoVariator_ticks (sine) --period {args.period} --amplitude {args.amplitude} --spacing {args.spacing}'),
+            "Variator program" : variator_program('tempoVariator_ticks', args.curve, curve_params, args.spacing, args.tolerance),
+            "Tempo curve" : describe(args.curve, curve_params),
         })
 
 
@@ -1,126 +1,140 @@
 import mido
-import math
 import argparse
 
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from modules.midiscoretools import update_json_metadata
+from modules import smfreader
+from modules.midiscoretools import update_json_metadata, parse_midi, getNumber
+from modules.smfwriter import rewrite_tempo_track, write_with_track
+from modules.tempocurves import CurveSampler, tempo_factors, describe, target_times_from_seconds, adaptive_tempo_events, assign_tempo_events
+from modules.tempocurves import add_curve_arguments, curve_params_from_args, variator_program
 
-def sine_wave(period, amplitude, time):
+def find_last_event_tick(smf):
+    return max(smf.end_ticks())
+
+def adaptive_tempo_track(smf, tolerance, curve="sine", curve_params=None, last_event_tick=None):
     """
-    A sin wave interpreted as units in octaves (eg,  sin[-1,1] maps to [.5, 2].
+    RETURNS: the bytes of a new track 0 for smf, with tempo events only where they are needed
+    to keep every tick within tolerance seconds of where the continuous tempo curve puts it
     """
-    frequency = 2 * math.pi / period
-    sine_value = math.sin(frequency * time)
-    return 2 ** (sine_value * amplitude)
+    curve_params = curve_params or {}
+    if last_event_tick == None:
+        last_event_tick = find_last_event_tick(smf)
 
-def find_last_event_tick(midi_file):
-    return max(sum(msg.time for msg in track) for track in midi_file.tracks)
+    track0 = smf.tracks[0]
+    is_tempo = (track0["type"] == smfreader.META) & (track0["meta_type"] == smfreader.SET_TEMPO)
+    tempo_ticks = track0["abs_tick"][is_tempo]
+    tempos = [getNumber(smf.payload(event), 3) for event in track0[is_tempo]]
 
-def process_midi_file(input_file, period, amplitude, spacing):
-    mid = mido.MidiFile(input_file)
-    output_mid = mido.MidiFile(type=mid.type, ticks_per_beat=mid.ticks_per_beat)
+    # (the original tempo changes start events of their own)
+    times = target_times_from_seconds(curve, last_event_tick, tempo_ticks, tempos, smf.ticks_per_quarter, **curve_params)
+    event_ticks, event_tempos = adaptive_tempo_events(times, smf.ticks_per_quarter, tolerance, breaks=tempo_ticks)
+    return rewrite_tempo_track(smf, *assign_tempo_events(event_ticks, event_tempos, tempo_ticks))
 
-    last_event_tick = find_last_event_tick(mid)
+def vary_tempo_track(smf, spacing, curve="sine", curve_params=None, last_event_tick=None, tolerance=None):
+    """
+    RETURNS: the bytes of a new track 0 (MTrk chunk) for smf, with its tempo varied by the tempo curve
+    (curve and curve_params choose it, see modules/tempocurves.py, evaluated at times in seconds)
+    With a tolerance (seconds), the tempo events are placed by adaptive_tempo_track instead of every spacing seconds
+    """
+    if tolerance != None:
+        return adaptive_tempo_track(smf, tolerance, curve, curve_params, last_event_tick)
+    curve_params = curve_params or {}
+    if last_event_tick == None:
+        last_event_tick = find_last_event_tick(smf)
 
-    tempo_track = mido.MidiTrack()
-    output_mid.tracks.append(tempo_track)
+    track0 = smf.tracks[0]
+    ticks_per_beat = smf.ticks_per_quarter
+    is_tempo = ((track0["type"] == smfreader.META) & (track0["meta_type"] == smfreader.SET_TEMPO)).tolist()
 
     current_tempo = 500000  # Default tempo (120 BPM)
-    last_tempo_change_tick = 0
     cumulative_tick = 0
     cumulative_time = 0.0
+    # tempo factors at the sample times spacing, 2*spacing, ... computed a block at a time
+    sampler = CurveSampler(curve, spacing, **curve_params)
+    sample_index = 0
     next_sample_time = spacing
 
     # Collect all original tempo changes
     tempo_changes = []
-    for msg in mid.tracks[0]:
-        cumulative_tick += msg.time
-        if msg.type == 'set_tempo':
-            tempo_changes.append((cumulative_tick, msg.tempo))
-            current_tempo = msg.tempo
+    for event, tempo_event in zip(track0, is_tempo):
+        if tempo_event:
+            tempo_changes.append((int(event["abs_tick"]), getNumber(smf.payload(event), 3)))
+    # until the first tempo change, the original tempo is the first one (as in TempoMap)
+    first_tempo = tempo_changes[0][1] if tempo_changes else current_tempo
+    current_tempo = first_tempo
 
-    cumulative_tick = 0
     last_original_tempo_index = -1
-
-    # Process tempo track (track 0)
-    for msg in mid.tracks[0]:
-        delta_ticks = msg.time
-        cumulative_tick += delta_ticks
-        delta_time = mido.tick2second(delta_ticks, mid.ticks_per_beat, current_tempo)
+    last_event = 0  # tick of the last event put in the new track
+    new_ticks, new_tempos, varied_tempos = [], [], []
+
+    # Process tempo track (track 0): only the new tempo events and tempos are worked out here, rewrite_tempo_track does the rest
+    for tick, tempo_event in zip(track0["abs_tick"].tolist(), is_tempo):
+        delta_ticks = tick - cumulative_tick
+        cumulative_tick = tick
+        delta_time = mido.tick2second(delta_ticks, ticks_per_beat, current_tempo)
         cumulative_time += delta_time
 
         while cumulative_time >= next_sample_time and cumulative_tick < last_event_tick:
             # Calculate ticks to the next sample point
-            ticks_to_next_sample = mido.second2tick(next_sample_time - (cumulative_time - delta_time), mid.ticks_per_beat, current_tempo)
+            ticks_to_next_sample = mido.second2tick(next_sample_time - (cumulative_time - delta_time), ticks_per_beat, current_tempo)
             
             if ticks_to_next_sample > 0 and ticks_to_next_sample < delta_ticks:
-                factor = sine_wave(period, amplitude, next_sample_time)
+                factor = sampler[sample_index]
                 
                 # Find the current original tempo
                 while last_original_tempo_index + 1 < len(tempo_changes) and tempo_changes[last_original_tempo_index + 1][0] <= cumulative_tick:
                     last_original_tempo_index += 1
-                original_tempo = tempo_changes[last_original_tempo_index][1] if last_original_tempo_index >= 0 else current_tempo
+                original_tempo = tempo_changes[last_original_tempo_index][1] if last_original_tempo_index >= 0 else first_tempo
                 
                 new_tempo = int(original_tempo / factor)
                 
                 # Insert new tempo change
-                new_tempo_msg = mido.MetaMessage('set_tempo', tempo=new_tempo, time=ticks_to_next_sample)
-                tempo_track.append(new_tempo_msg)
+                last_event += ticks_to_next_sample
+                new_ticks.append(last_event)
+                new_tempos.append(new_tempo)
                 
                 # Adjust remaining ticks for the current message
                 delta_ticks -= ticks_to_next_sample
                 current_tempo = new_tempo
 
-            next_sample_time += spacing
+            sample_index += 1
+            next_sample_time = (sample_index + 1) * spacing  # (not a running sum, which drifts)
 
-        # Add the original message (or its remainder) with adjusted time
-        if msg.type == 'set_tempo':
-            factor = sine_wave(period, amplitude, cumulative_time)
-            new_tempo = int(msg.tempo / factor)
-            new_msg = mido.MetaMessage('set_tempo', tempo=new_tempo, time=delta_ticks)
+        # The original message keeps its tick (original tempo changes are varied too)
+        if tempo_event:
+            factor = tempo_factors(curve, [cumulative_time], **curve_params)[0]
+            new_tempo = int(tempo_changes[len(varied_tempos)][1] / factor)
+            varied_tempos.append(new_tempo)
             current_tempo = new_tempo
-        else:
-            new_msg = msg.copy(time=delta_ticks)
-        
-        if delta_ticks > 0:
-            tempo_track.append(new_msg)
-
-    # Process other tracks (copy as is)
-    for track in mid.tracks[1:]:
-        new_track = mido.MidiTrack()
-        output_mid.tracks.append(new_track)
-        for msg in track:
-            new_track.append(msg.copy())
-
-    # Ensure all tracks end with end_of_track message
-    for track in output_mid.tracks:
-        if track[-1].type != 'end_of_track':
-            track.append(mido.MetaMessage('end_of_track', time=0))
-
-    return output_mid
-    
+        last_event = cumulative_tick
+
+    return rewrite_tempo_track(smf, new_ticks, new_tempos, varied_tempos)
+
+def process_midi_file(input_file, output_file, spacing, curve="sine", curve_params=None, tolerance=None):
+    # the other tracks are copied byte for byte, since delta ticks don't change with the tempo
+    smf = parse_midi(input_file).smf
+    write_with_track(smf, output_file, 0, vary_tempo_track(smf, spacing, curve, curve_params, tolerance=tolerance))
 
 def main():
-    parser = argparse.ArgumentParser(description="Vary tempo of a MIDI file using a sine wave")
+    parser = argparse.ArgumentParser(description="Vary tempo of a MIDI file using a tempo curve (a sine wave by default)")
     parser.add_argument("-m", "--midi", required=True, help="Input MIDI file")
     parser.add_argument("-om", "--output", required=True, help="Output MIDI file")
-    parser.add_argument("-p", "--period", type=float, required=True, help="Sine wave period in seconds")
-    parser.add_argument("-a", "--amplitude", type=float, required=True, help="Sine wave amplitude in octaves")
-    parser.add_argument("-sp", "--spacing", type=float, required=True, help="Spacing between new tempo events in seconds")
+    add_curve_arguments(parser, "seconds")
     parser.add_argument("-j", "--metadata", nargs="?", default=None, help="Path to the variation metadata json")
     
     args = parser.parse_args()
 
-    output_mid=process_midi_file(args.midi, args.period, args.amplitude, args.spacing)
+    curve_params = curve_params_from_args(parser, args)
     os.makedirs(os.path.dirname(args.output), exist_ok=True)
-    output_mid.save(args.output)
+    process_midi_file(args.midi, args.output, args.spacing, args.curve, curve_params, args.tolerance)
 
 
     if (args.metadata != None) : 
         update_json_metadata(args.metadata, {
-            "Variator program" : f'tempoVariator_time (sine) --period {args.period} --amplitude {args.amplitude} --spacing {args.spacing}',
+            "Variator program" : variator_program('tempoVariator_time', args.curve, curve_params, args.spacing, args.tolerance),
+            "Tempo curve" : describe(args.curve, curve_params),
         })
 
 
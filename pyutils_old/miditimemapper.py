@@ -1,6 +1,10 @@
 import mido
 import argparse
-from bisect import bisect_right
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.midiscoretools import TempoMap
 
 def read_input_times(file_path):
     with open(file_path, 'r') as f:
@@ -11,55 +15,44 @@ def write_output_times(file_path, mapped_times):
         for start, end, label in mapped_times:
             f.write(f"{start:.6f}\t{end:.6f}\t{label}\n")
 
-def compute_time_array(midi_file):
+def compute_tempo_map(midi_file):
     mid = mido.MidiFile(midi_file)
     ticks_total = sum(msg.time for msg in mid.tracks[0])
-    time_array = [0.0] * (ticks_total + 1)
-    
-    current_tempo = 500000  # Default tempo (120 BPM)
+
+    tempo_ticks = [0]
+    tempos = [500000]  # Default tempo (120 BPM) until the first set_tempo
     current_tick = 0
-    current_time = 0.0
-    
+
     for msg in mid.tracks[0]:
-        for tick in range(current_tick, current_tick + msg.time):
-            time_array[tick] = current_time
-        
-        delta_time = mido.tick2second(msg.time, mid.ticks_per_beat, current_tempo)
-        current_time += delta_time
         current_tick += msg.time
-        
         if msg.type == 'set_tempo':
-            current_tempo = msg.tempo
-    
-    time_array[-1] = current_time  # Set the last element to the total duration
-    return time_array, ticks_total
+            if current_tick == tempo_ticks[-1]:
+                tempos[-1] = msg.tempo
+            else:
+                tempo_ticks.append(current_tick)
+                tempos.append(msg.tempo)
 
-def map_time(time, source_array, target_array):
-    if time == 0:
-        return 0
-    index = bisect_right(source_array, time) - 1
-    source_time1, source_time2 = source_array[index], source_array[index + 1]
-    target_time1, target_time2 = target_array[index], target_array[index + 1]
-    
-    # Linear interpolation
-    ratio = (time - source_time1) / (source_time2 - source_time1)
-    return target_time1 + ratio * (target_time2 - target_time1)
+    return TempoMap(tempo_ticks, tempos, mid.ticks_per_beat), ticks_total
 
 def map_times(midi_file1, midi_file2, input_times_file, output_times_file):
-    a1, ticks1 = compute_time_array(midi_file1)
-    a2, ticks2 = compute_time_array(midi_file2)
+    m1, ticks1 = compute_tempo_map(midi_file1)
+    m2, ticks2 = compute_tempo_map(midi_file2)
     
     if ticks1 != ticks2:
         raise ValueError(f"The two MIDI files have different numbers of ticks: {ticks1} vs {ticks2}")
     
     input_events = read_input_times(input_times_file)
-    mapped_events = []
-    
-    for start, end, label in input_events:
-        new_start = map_time(start, a1, a2)
-        new_end = map_time(end, a1, a2)
-        mapped_events.append((new_start, new_end, label))
-    
+    if not input_events:
+        write_output_times(output_times_file, [])
+        return
+
+    starts, ends, labels = zip(*input_events)
+
+    # time in file 1 -> (fractional) tick -> time in file 2, for all the labels at once
+    new_starts = m2.ticks_to_seconds(m1.seconds_to_ticks(starts, fractional=True))
+    new_ends = m2.ticks_to_seconds(m1.seconds_to_ticks(ends, fractional=True))
+
+    mapped_events = list(zip(new_starts.tolist(), new_ends.tolist(), labels))
     write_output_times(output_times_file, mapped_events)
 
 def main():
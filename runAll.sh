@@ -7,6 +7,9 @@ folder="scores/BartokRFD1/"
 score="BartokRFD1"
 vartag="v001"
 
+# Optional: keep parsed midi files in an on-disk cache shared by all the stages and runs (see modules/midicache.py)
+# export SCORETIMING_MIDI_CACHE="${HOME}/.cache/scoretiming/midi"
+
 # Function to run Python script and check for errors
 run_python_script() {
     echo "Running: python $@"  # Print the command with all arguments expanded